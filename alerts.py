@@ -5,19 +5,21 @@ collection of functions which trigger market alerts
 """
 
 import matplotlib.dates as dates
+import numpy as np
 import mdcache
 import sto
-import ystockquote
+import quotecache
 import datetime
 from decimal import *
 
 D = Decimal
 
 
-def sto_limits (symbols=None, debug=False):
+def sto_limits (symbols=None, debug=False, deadline=None):
 	"""
 	alerts based on a high (80+) or low (20-) stochastic value (10-day period)
 	shows if price at last close was either strong or weak relative to all price movement over the period
+	symbols not loaded / quoted by deadline (see fetcher.py) are skipped
 	"""
 	if symbols is None:
 		symbols = mdcache.entries()
@@ -30,22 +32,50 @@ def sto_limits (symbols=None, debug=False):
 
 	todaynum = dates.date2num(datetime.date.today())
 
+	(loaded, failed) = mdcache.prefetch(symbols, deadline=deadline)
+
+	# last 10 bars per symbol as floats, straight from the cached columns
+	history = {}
 	for symbol in symbols:
-		data = mdcache.mdcache(symbol).get_data()[-10:]
+		if symbol not in loaded:
+			print("Error getting %s history, skipping" % symbol)
+			continue
+		cols = loaded[symbol].get_columns()
+		if len(cols['date']):
+			history[symbol] = dict([(name, cols[name][-10:]) for name in ('date', 'close', 'high', 'low')])
+
+	# one batched quote request for everything without a bar for today
+	spots = quotecache.get_prices([s for s in history if history[s]['date'][-1] < todaynum],
+			deadline=deadline)
 
-		if data[-1][0] < todaynum:
+	ready = []
+	for symbol in symbols:
+		if symbol not in history:
+			continue
+
+		bars = history[symbol]
+		if bars['date'][-1] < todaynum:
 			if debug:
 				print("%s: adding current spot" % symbol)
 
-			try:
-				spot = D(ystockquote.get_price(symbol))
-			except (IOError, InvalidOperation):
+			if symbol not in spots:
 				print("Error getting %s spot, skipping" % symbol)
 				continue
+			spot = float(spots[symbol])
+			bars = dict([(name, np.append(bars[name], spot)) for name in ('close', 'high', 'low')])
+
+		ready += [(symbol, bars)]
 
-			data += [[todaynum, spot, spot, spot, spot, 0]]
+	# the whole lot in one vectorized pass
+	(k, d) = sto.sto_batch(
+			sto.align([bars['close'] for (symbol, bars) in ready], 11),
+			sto.align([bars['high'] for (symbol, bars) in ready], 11),
+			sto.align([bars['low'] for (symbol, bars) in ready], 11),
+		)[10]
 
-		value = sto.sto(data)[-1][0]
+	for (i, (symbol, bars)) in enumerate(ready):
+		# prices are in cents, so %K often lands right on a threshold, which float error mustn't move
+		value = round(k[i, -1], 9)
 
 		if value >= 80:
 			res['strong'] += [(symbol, value)]
@@ -2,7 +2,7 @@
 
 from mdcache import mdcache
 import datetime
-from sto import sto
+from sto import sto, StoStream
 from account import account
 import matplotlib.dates as dates
 import commission
@@ -38,16 +38,22 @@ def backtest(symbol=None, start=None, write_to_disk=False, fixed_value=None):
 	next_sell_qty = None
 	x = None	# last xact
 
+	# sto(data[:end]), kept current a bar at a time rather than recomputed
+	entry_sto = StoStream()
+
 	for (d, o, c, h, l, v) in data:
 		if d == 733898.0:
 			# flash crash
 			continue
 
 		end += 1
+		# N.B. past the flash crash data[end-1] is the bar before this one, as data[:end] always was
+		entry_sto.update(data[end-1])
+
 		# date, open, close, high, low, volume
 		if pos_qty is None:
 			# no buys yet, waiting for weakness to enter
-			if sto(data[:end])[-1][0] > 20.:
+			if entry_sto.value is None or entry_sto.value[0] > 20.:
 				continue
 
 			# weakness detected -- entry point
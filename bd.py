@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import urllib
+import provider
 from BeautifulSoup import *
 
 class BDQuote (object):
@@ -10,7 +10,7 @@ class BDQuote (object):
 		}
 	
 	def __init__(self, acct):
-		html = urllib.urlopen(self.urlmap[acct]).read()
+		html = provider.get().page(self.urlmap[acct])
 		self.bs = BeautifulSoup(html)
 		t = self.bs.find(name='table', attrs={'class': 'tableRightSideFieldContainer'})
 		(self.bid, self.ask) = t.findAll('table')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+fetch engine for quote and history requests
+
+	value = fetcher.retry(fn, deadline=d)			one request, retried with backoff
+	(results, errors) = fetcher.run(jobs, deadline=d)	many at once, jobs is key -> callable
+
+each run() feeds its jobs to at most `workers` threads, and at most `workers`
+requests run at a time across the whole process (a shared semaphore, so the alert
+loop and the gui can't pile onto the network together).
+every attempt is bounded by the socket timeout of the http pool, and no attempt
+or backoff sleep is started past a request's deadline.  run() returns when all
+jobs are done or the deadline passes, whichever is first, with whatever finished
+by then: jobs still out are reported as Timeout errors and cancelled, and any
+that are blocked on the network are left to finish in the background.
+
+fetcher.deadline() gives the deadline for an alert cycle, so a slow or dead feed
+delays the alerts by at most cycle_timeout (plus one socket timeout)
+"""
+
+import time, random, threading, Queue
+
+
+workers = 8
+
+# attempts per request, with jittered exponential backoff in between
+attempts = 5
+retry_base = 0.25
+retry_cap = 4
+
+# wall clock budget for one request including its retries, and for a whole alert cycle
+request_timeout = 30
+cycle_timeout = 120
+
+slots = threading.BoundedSemaphore(workers)
+
+
+def after_fork ():
+	"""
+	for a forked child process, slots held by threads of the parent are never given back there
+	"""
+	global slots
+	slots = threading.BoundedSemaphore(workers)
+
+
+class Timeout (IOError):
+	"""
+	a request ran out of time, or was cancelled
+	an IOError so existing network error handling covers it
+	"""
+	pass
+
+
+def deadline (seconds=None):
+	"""
+	absolute deadline seconds (default: cycle_timeout) from now
+	"""
+	if seconds is None:
+		seconds = cycle_timeout
+	return time.time() + seconds
+
+
+def retry (fn, retry_on=(IOError,), deadline=None, cancel=None):
+	"""
+	calls fn() until it returns, retrying the retry_on exceptions with backoff
+	raises the last error once attempts are used up, or Timeout if the deadline
+	passes or the cancel event is set before it succeeds
+	"""
+	strikes = 0
+	while True:
+		if cancel is not None and cancel.is_set():
+			raise Timeout("cancelled")
+		try:
+			return fn()
+		except retry_on, e:
+			strikes += 1
+			if strikes >= attempts:
+				raise
+
+		delay = random.uniform(0, min(retry_cap, retry_base * 2 ** strikes))
+		if deadline is not None and time.time() + delay >= deadline:
+			raise Timeout("deadline passed after %d attempts: %s" % (strikes, e))
+		if cancel is not None:
+			cancel.wait(delay)
+		else:
+			time.sleep(delay)
+
+
+def run (jobs, deadline=None, retry_on=(IOError,), timeout=None):
+	"""
+	runs the jobs (key -> callable) concurrently, each through retry(), on a pool of
+	`workers` threads taking them from a queue
+	each job gets timeout seconds (default: request_timeout) from when it starts, but
+	never past deadline
+
+	returns (results, errors) dicts keyed like jobs: return values, and the exception
+	a job failed with (Timeout for those unfinished when the deadline passed)
+	"""
+	if timeout is None:
+		timeout = request_timeout
+
+	results = {}
+	errors = {}
+	cond = threading.Condition()
+	cancel = threading.Event()
+
+	pending = Queue.Queue()
+	for item in jobs.items():
+		pending.put(item)
+
+	def run_one (key, fn):
+		slots.acquire()
+		try:
+			job_deadline = time.time() + timeout
+			if deadline is not None:
+				job_deadline = min(job_deadline, deadline)
+			try:
+				res = retry(fn, retry_on=retry_on, deadline=job_deadline, cancel=cancel)
+			except Exception, e:
+				res = e
+				failed = True
+			else:
+				failed = False
+		finally:
+			slots.release()
+
+		with cond:
+			if key in results or key in errors:
+				# timed out already, the caller has moved on
+				return
+			if failed:
+				errors[key] = res
+			else:
+				results[key] = res
+			cond.notify()
+
+	def work ():
+		while not cancel.is_set():
+			try:
+				(key, fn) = pending.get_nowait()
+			except Queue.Empty:
+				return
+			run_one(key, fn)
+
+	for i in range(min(workers, len(jobs))):
+		t = threading.Thread(target=work)
+		t.daemon = True
+		t.start()
+
+	with cond:
+		while len(results) + len(errors) < len(jobs):
+			if deadline is None:
+				# a timeout keeps the wait interruptible
+				cond.wait(60)
+				continue
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			cond.wait(remaining)
+
+		cancel.set()
+		for key in jobs:
+			if key not in results and key not in errors:
+				errors[key] = Timeout("no answer by the deadline")
+
+	return (results, errors)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+shared keep-alive http connection pool
+
+quote lookups hit the same couple of hosts over and over, so idle connections are
+kept per host and reused instead of paying a dns lookup and tcp handshake per
+request.  at most per_host connections to a host are in use at once, and every
+connection carries a socket timeout.
+
+	body = httppool.fetch(url)
+	for line in httppool.request(url): ...	# streamed, connection reused once drained
+
+errors are raised as urllib2.HTTPError (status >= 400) / urllib2.URLError so the
+existing network error handling covers them
+"""
+
+import time, socket, threading, httplib, urllib2
+from urlparse import urlsplit
+
+
+class Response (object):
+	"""
+	body of a pooled request
+	the connection goes back to the pool once the body has been read to the end
+	"""
+
+	blocksize = 16384
+
+	def __init__ (self, pool, key, conn, resp):
+		self.pool = pool
+		self.key = key
+		self.conn = conn
+		self.resp = resp
+		self.status = resp.status
+
+
+	def read (self):
+		try:
+			data = self.resp.read()
+		except (socket.error, httplib.HTTPException), e:
+			self.close(reuse=False)
+			raise urllib2.URLError(e)
+		self.close()
+		return data
+
+
+	def __iter__ (self):
+		"""
+		yields the body a line at a time (line endings kept) without holding all of it
+		"""
+		tail = ''
+		try:
+			while True:
+				try:
+					block = self.resp.read(self.blocksize)
+				except (socket.error, httplib.HTTPException), e:
+					raise urllib2.URLError(e)
+				if not block:
+					break
+				lines = (tail + block).split('\n')
+				tail = lines.pop()
+				for line in lines:
+					yield line + '\n'
+		finally:
+			# also runs if the caller stops early, the connection is then dropped
+			self.close()
+		if tail:
+			yield tail
+
+
+	def close (self, reuse=True):
+		if self.conn is None:
+			return
+		# only a fully read response leaves the connection usable
+		reuse = reuse and self.resp.isclosed() and not self.resp.will_close
+		self.pool.release(self.key, self.conn, reuse)
+		self.conn = None
+
+
+
+class Pool (object):
+	"""
+	keep-alive connections grouped by (scheme, host, port)
+	"""
+
+	def __init__ (self, per_host=4, timeout=10):
+		self.per_host = per_host
+		self.timeout = timeout
+		self.idle = {}		# key -> list of idle connections
+		self.busy = {}		# key -> count of connections handed out
+		self.cond = threading.Condition()
+
+
+	def acquire (self, key):
+		"""
+		returns (conn, reused), waiting up to timeout for a free slot on the host
+		"""
+		deadline = time.time() + self.timeout
+		with self.cond:
+			while self.busy.get(key, 0) >= self.per_host:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise urllib2.URLError("timed out waiting for a connection to %s" % key[1])
+				self.cond.wait(remaining)
+			self.busy[key] = self.busy.get(key, 0) + 1
+			idle = self.idle.get(key)
+			if idle:
+				return (idle.pop(), True)
+
+		(scheme, host, port) = key
+		if scheme == 'https':
+			conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+		else:
+			conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+		return (conn, False)
+
+
+	def release (self, key, conn, reuse):
+		with self.cond:
+			self.busy[key] -= 1
+			if reuse:
+				self.idle.setdefault(key, []).append(conn)
+			self.cond.notify()
+		if not reuse:
+			conn.close()
+
+
+	def request (self, url):
+		"""
+		issues a GET, returns a Response to read or iterate
+		"""
+		parts = urlsplit(url)
+		key = (parts.scheme, parts.hostname, parts.port)
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+
+		for attempt in (1, 2):
+			(conn, reused) = self.acquire(key)
+			try:
+				conn.request('GET', path, headers={'Connection': 'keep-alive'})
+				resp = conn.getresponse()
+				break
+			except (socket.error, httplib.HTTPException), e:
+				self.release(key, conn, False)
+				if reused and attempt == 1:
+					# the server dropped an idle connection, try a fresh one
+					continue
+				raise urllib2.URLError(e)
+
+		res = Response(self, key, conn, resp)
+		if resp.status >= 400:
+			res.read()
+			raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, None)
+		return res
+
+
+	def fetch (self, url):
+		"""
+		issues a GET, returns the body
+		"""
+		return self.request(url).read()
+
+
+	def close (self):
+		"""
+		drops all idle connections
+		"""
+		with self.cond:
+			idle = self.idle
+			self.idle = {}
+		for conns in idle.values():
+			for conn in conns:
+				conn.close()
+
+
+
+# the pool every quote fetch path shares
+pool = Pool()
+
+def after_fork ():
+	"""
+	for a forked child process: the parent's connections (and the lock over them) are
+	left alone and the child starts a pool of its own
+	"""
+	global pool
+	pool = Pool(pool.per_host, pool.timeout)
+
+def request (url):
+	return pool.request(url)
+
+def fetch (url):
+	return pool.fetch(url)
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
-import os, datetime, json, time, traceback
+import os, datetime, time, traceback, random, json
+import threading
+from collections import OrderedDict, deque
 import urllib2	# for exceptions
-from matplotlib.finance import quotes_historical_yahoo
 import matplotlib.dates as dates
+import mdstore
+import provider
+import fetcher
+import tradecal
 
 from decimal import *
 
@@ -12,22 +17,316 @@ D = Decimal
 
 cachedir = '/var/tmp/mdcache'
 
+# seconds after a network check for newer bars during which we don't check again
+refresh_ttl = 30 * 60
+
+# history fetch attempts per range, with jittered exponential backoff between them (seconds)
+fetch_attempts = 5
+retry_base = 0.5
+retry_cap = 8
+
+# after a symbol's history fetch fails it isn't tried again for negative_ttl seconds,
+# doubling with each consecutive failure up to negative_ttl_max.  state persists in failfile
+negative_ttl = 15 * 60
+negative_ttl_max = 24 * 60 * 60
+failfile = os.path.join(cachedir, '.failures')
+
 
 class DataError (Exception):
 	pass
 
 
+def after_fork ():
+	"""
+	for a child process forked while fetch threads may have been running (see pnf.scan())
+	a lock one of them held at the fork would never be released in the child, so the
+	locks are replaced, and state that lock was guarding is dropped in case it was caught
+	mid update.  the store backend gets its own connections too
+	"""
+	global histories_lock, histories_bytes, failures_lock, failures_mtime
+
+	if not histories_lock.acquire(False):
+		histories.clear()
+		histories_bytes = 0
+	histories_lock = threading.Lock()
+
+	# read back from failfile on next use
+	failures_mtime = None
+	failures_lock = threading.Lock()
+
+	mdstore.after_fork()
+
+
 def entries ():
 	"""
 	returns a list of cached symbols
 	"""
-	return(os.listdir(cachedir))
+	return(mdstore.entries(cachedir))
+
+
+# process-wide LRU of loaded histories, so pnf, alerts and the charts share one load per symbol
+# keyed by upper-cased symbol, most recently used last
+histories = OrderedDict()
+histories_lock = threading.Lock()
+histories_bytes = 0
+
+# upper bound on the column data and converted rows (see RowMemo) held in histories
+history_cache_bytes = 64 * 1024 * 1024
+
+# converted rows kept per history, and roughly what one costs (a tuple of Decimals)
+memo_rows = 2048
+memo_row_bytes = 700
+
+
+failures = {}
+failures_mtime = None
+failures_lock = threading.Lock()
+
+
+def _read_failures ():
+	"""
+	refreshes failures from failfile if another process (or nobody yet) has changed it
+	call with failures_lock held
+	"""
+	global failures, failures_mtime
+
+	try:
+		mtime = os.path.getmtime(failfile)
+	except OSError:
+		failures = {}
+		failures_mtime = None
+		return
+	if mtime == failures_mtime:
+		return
+
+	try:
+		f = open(failfile)
+		try:
+			failures = json.loads(f.read())
+		finally:
+			f.close()
+	except (IOError, ValueError):
+		failures = {}
+	failures_mtime = mtime
+
+
+def _write_failures ():
+	"""
+	every process (and pnf.scan() worker) shares failfile, each writing through its own temp file
+	the negative cache is only advisory, so a write that fails is dropped
+	"""
+	global failures_mtime
+
+	tmp = '%s.tmp-%s' % (failfile, mdstore.writer())
+	try:
+		f = open(tmp, 'w')
+		f.write(json.dumps(failures))
+		f.close()
+		os.rename(tmp, failfile)
+		failures_mtime = os.path.getmtime(failfile)
+	except (IOError, OSError), e:
+		print("WARNING: cannot save %s: %s" % (failfile, e))
+		if os.path.exists(tmp):
+			os.unlink(tmp)
+
+
+def retry_after (symbol):
+	"""
+	returns the time (secs since epoch) before which symbol's history shouldn't be fetched
+	again, or None if it isn't being backed off
+	"""
+	with failures_lock:
+		_read_failures()
+		state = failures.get(symbol.upper())
+	if state is None or state['retry_after'] <= time.time():
+		return None
+	return state['retry_after']
+
+
+def record_failure (symbol):
+	"""
+	negative caches symbol, for twice as long as last time
+	"""
+	key = symbol.upper()
+	with failures_lock:
+		_read_failures()
+		count = failures.get(key, {'count': 0})['count'] + 1
+		ttl = min(negative_ttl * 2 ** (count - 1), negative_ttl_max)
+		failures[key] = {'count': count, 'retry_after': time.time() + ttl}
+		_write_failures()
+
+
+def clear_failure (symbol):
+	key = symbol.upper()
+	with failures_lock:
+		_read_failures()
+		if key in failures:
+			del failures[key]
+			_write_failures()
+
+
+def covered (meta, last=None):
+	"""
+	sorted list of [low, high] date num ranges (inclusive) already fetched into a store
+
+	stores written before range tracking cover one span, from date_low to last (the
+	date of the last bar stored).  their date_high can be a requested day that never
+	got its bar, so it isn't trusted
+	"""
+	if 'ranges' in meta:
+		return [list(r) for r in meta['ranges']]
+	if 'date_low' in meta and last is not None and last >= meta['date_low']:
+		return [[meta['date_low'], last]]
+	return []
+
+
+def uncovered (ranges, date_from, date_to):
+	"""
+	returns the [low, high] sub-ranges of date_from..date_to missing from ranges
+	"""
+	res = []
+	lo = date_from
+	for (r_lo, r_hi) in ranges:
+		if r_hi < lo:
+			continue
+		if r_lo > date_to:
+			break
+		if r_lo > lo:
+			res += [[lo, r_lo - 1]]
+		lo = r_hi + 1
+	if lo <= date_to:
+		res += [[lo, date_to]]
+	return res
+
+
+def add_range (ranges, lo, hi):
+	"""
+	returns ranges with lo..hi added
+	ranges that overlap, touch, or are separated only by days the exchange was closed are merged
+	"""
+	res = []
+	for (r_lo, r_hi) in sorted(ranges + [[lo, hi]]):
+		if res and (r_lo <= res[-1][1] + 1 or not bars_possible(res[-1][1] + 1, r_lo - 1)):
+			res[-1][1] = max(res[-1][1], r_hi)
+		else:
+			res += [[r_lo, r_hi]]
+	return res
+
+
+def bars_possible (first, last):
+	"""
+	true if the exchange was open on any day between date nums first and last (inclusive)
+	"""
+	if last < first:
+		return False
+	return tradecal.has_session(dates.num2date(first).date(), dates.num2date(last).date())
+
+
+def recall (symbol, date_from, date_to):
+	"""
+	returns the loaded history entry for symbol if it already covers date_from..date_to (date nums)
+	"""
+	key = symbol.upper()
+	with histories_lock:
+		entry = histories.get(key)
+		if entry is None or date_from < entry['date_from'] or date_to > entry['date_to']:
+			return None
+		# mark most recently used
+		del histories[key]
+		histories[key] = entry
+
+	datenums = entry['columns']['date']
+	if len(datenums) and time.time() - entry['loaded'] > refresh_ttl:
+		# long lived process, a bar may have been published since this was loaded
+		latest = dates.date2num(tradecal.last_session())
+		if bars_possible(datenums[-1] + 1, min(date_to, latest)):
+			return None
+
+	return entry
+
+
+def remember (symbol, date_from, date_to, meta, cols):
+	"""
+	records a freshly loaded (or refreshed) history, replacing any older entry for the symbol
+	evicts least recently used histories to stay under history_cache_bytes
+	returns the new entry
+	"""
+	global histories_bytes
+
+	key = symbol.upper()
+	entry = {
+			'meta':			meta,
+			'columns':		cols,
+			'memo':			RowMemo(memo_rows),
+			'loaded':		time.time(),
+			'date_from':	date_from,
+			'date_to':		date_to,
+			'nbytes':		sum([cols[name].nbytes for name in mdstore.columns]),
+		}
+
+	with histories_lock:
+		old = histories.pop(key, None)
+		if old is not None:
+			# cols only cover date_from..date_to, so this replaces the old range
+			histories_bytes -= old['nbytes']
+
+		histories[key] = entry
+		histories_bytes += entry['nbytes']
+
+		# histories_bytes only counts the columns, the memos grow as rows are read
+		memo_bytes = sum([len(e['memo']) for e in histories.itervalues()]) * memo_row_bytes
+		while histories_bytes + memo_bytes > history_cache_bytes and len(histories) > 1:
+			(k, evicted) = histories.popitem(last=False)
+			histories_bytes -= evicted['nbytes']
+			memo_bytes -= len(evicted['memo']) * memo_row_bytes
+
+	return entry
+
+
+def forget (symbol=None):
+	"""
+	drops the loaded history for symbol, or all of them
+	the next mdcache() for it goes back to the store (and the network if needed)
+	"""
+	global histories_bytes
+
+	with histories_lock:
+		if symbol is None:
+			histories.clear()
+			histories_bytes = 0
+		else:
+			old = histories.pop(symbol.upper(), None)
+			if old is not None:
+				histories_bytes -= old['nbytes']
+
+
+def prefetch (symbols, date_from=None, date_to=None, deadline=None):
+	"""
+	loads / refreshes many symbols concurrently through the fetch engine (fetcher.py)
+	date args are as for mdcache(), deadline is an absolute time.time() value
+
+	returns (loaded, failed) dicts keyed by symbol: the mdcache instances, and the
+	exception raised for any symbol that could not be loaded (fetcher.Timeout for
+	those not loaded by the deadline).  a failure on one symbol doesn't hold up or
+	abort the others
+	"""
+	def load (symbol):
+		return lambda: mdcache(symbol, date_from=date_from, date_to=date_to)
+
+	# mdcache does its own retrying, see get_data_from_provider()
+	jobs = dict([(symbol, load(symbol)) for symbol in symbols])
+	(loaded, failed) = fetcher.run(jobs, deadline=deadline, retry_on=())
+
+	for symbol in sorted(failed):
+		print("Error loading %s history: %s" % (symbol, failed[symbol]))
+
+	return (loaded, failed)
 
 
 class mdcache (object):
 	"""
 	Data abstraction layer for historical HLOC data
-	maintains a cache of symbol data retrieved from yahoo
+	maintains a cache of symbol data retrieved from the market data provider (see provider.py)
 	subsequent calls fill in any gaps from the cache if needed and return that
 	"""
 
@@ -56,120 +355,171 @@ class mdcache (object):
 			date_from = today - datetime.timedelta(days=365)
 		self.date_from = dates.date2num(date_from)
 
-		symfname = os.path.join(cachedir, symbol.upper())
-
-		if os.path.exists(symfname):
-			f = open(symfname)
+		self.store = mdstore.store(cachedir, symbol)
 
-			try:
-				data = json.loads(f.read())
-			except ValueError, e:
-				# No JSON object could be decoded
-				print("MDERROR -- Recovering by Invalidating %s: %s" % (symbol, e))
-				f.close()
-				os.unlink(symfname)
-				# return a reinstantiated object that takes the new-symbol code path in the ctor
-				return(mdcache.__init__(self, symbol, date_from=date_from, date_to=date_to))
+		entry = recall(symbol, self.date_from, self.date_to)
+		if entry is None:
+			self.load()
+			entry = remember(symbol, self.date_from, self.date_to, self.meta, self.columns)
 
-			f.close()
+		self.meta = entry['meta']
+		self.columns = entry['columns']
+		self.memo = entry['memo']
 
-			extend_early = False
-			extend_late  = False
-			refresh_from = data['hloc'][0][0]
-			refresh_to   = data['hloc'][-1][0]
-			if self.date_from < refresh_from:
-				extend_early = True
-				refresh_from = self.date_from
-				#print("1refresh_from: %s" % refresh_from)
-			else:
-				# don't need earlier data.  If we need any data it will be after the high date
-				refresh_from = data['hloc'][-1][0]
-				#print("2refresh_from: %s" % refresh_from)
-
-			if self.date_to > refresh_to:
-				extend_late = True
-				refresh_to = self.date_to
-				#print("1refresh_to: %s" % refresh_to)
-			else:
-				# don't need later data.  If we need any data it will be from before the low date
-				refresh_to = data['hloc'][0][0]
-				#print("2refresh_to: %s" % refresh_to)
-
-			if not(extend_early or extend_late):
-				# it's all in the cache
-				self.data = data
-				#print("it's all in the cache")
-				return
-
-			#print("fetching from %s to %s" % (refresh_from, refresh_to))
 
-			try:
-				quotes = self.get_data_from_yahoo(date_from=refresh_from, date_to=refresh_to)
-			except urllib2.URLError:
-				# network down?
-				print("WARNING: cannot retrieve quotes.  Cached data still available")
-				quotes = None
+	def load (self):
+		"""
+		reads the symbol's store, fetching whatever parts of the requested range it lacks
+		sets self.meta and self.columns
 
-			#print("quotes: %s" % quotes)
-
-			if quotes:
-				if extend_early and extend_late:
-					# total rewrite
-					data['hloc'] = quotes
-					data['date_low'] = refresh_from
-					data['date_high'] = refresh_to
-				elif extend_early:
-					# prepend but do not duplicate
-					if quotes[-1][0] == data['hloc'][0][0]:
-						quotes = quotes[:-1]
-					data['hloc'] = quotes + data['hloc']
-					data['date_low'] = refresh_from
-				elif extend_late:
-					# append but do not duplicate
-					if quotes is not None:	# this is often None during early am for current day
-						if quotes[0][0] == data['hloc'][-1][0]:
-							quotes = quotes[1:]
-						data['hloc'] += quotes
-						data['date_high'] = refresh_to
+		the store meta keeps the set of date ranges already fetched, so only the uncovered
+		sub-ranges (early, late or interior gaps) go to the network
+		"""
+		symbol = self.symbol
 
+		if self.store.exists():
+			try:
+				(meta, cols) = self.store.load(self.date_from, self.date_to)
+			except mdstore.StoreError, e:
+				print("MDERROR -- Recovering by Invalidating %s: %s" % (symbol, e))
+				self.store.remove()
+				# reload, taking the new-symbol code path
+				return(self.load())
 		else:
 			# new symbol in cache
+			meta = {}
+			cols = mdstore.to_columns([])
+
+		last = None
+		if 'ranges' not in meta and meta.get('rows'):
+			# stored before range tracking, see covered().  cols may not reach the last bar
+			last = float(self.store.load()[1]['date'][-1])
+		ranges = covered(meta, last)
+		new_ranges = list(ranges)
+
+		# newest bar that can have been published yet
+		latest = dates.date2num(tradecal.last_session())
+		checked = meta.get('checked', 0)
+		checked_recently = time.time() - checked < refresh_ttl
+
+		backoff = retry_after(symbol)
+
+		fetched = []
+		failed = False
+		attempted = False
+		for (lo, hi) in uncovered(ranges, self.date_from, min(self.date_to, latest)):
+			if not bars_possible(lo, hi):
+				# nothing but weekends / holidays
+				new_ranges = add_range(new_ranges, lo, hi)
+				continue
+
+			if backoff:
+				# failed recently, don't hold everyone up trying again yet
+				failed = True
+				continue
+
+			# past everything we've fetched before
+			late = not ranges or lo > ranges[-1][1]
+			if late and checked_recently:
+				continue
+
+			#print("fetching from %s to %s" % (lo, hi))
+
+			attempted = True
 			try:
-				quotes = self.get_data_from_yahoo(self.date_from, self.date_to)
+				quotes = self.get_data_from_provider(date_from=lo, date_to=hi)
 			except urllib2.URLError:
 				# network down?
-				print("ERROR: cannot retrieve quotes, and no relevant data in cache")
-				raise DataError("Network down?")
-
-			data = {}
-			data['date_low']  = self.date_from
-			data['date_high'] = self.date_to
-			data['hloc']      = quotes
+				quotes = None
 
-		# stash the cache
-		self.data = data
+			if quotes is None:
+				failed = True
+				continue
+
+			keep = (quotes['date'] >= lo) & (quotes['date'] <= hi)
+			quotes = dict([(name, quotes[name][keep]) for name in mdstore.columns])
+			if len(quotes['date']):
+				fetched += [quotes]
+
+			if late and hi >= latest:
+				# up to the latest session, whose bar may not be published yet
+				meta['checked'] = time.time()
+				if not len(quotes['date']):
+					# nothing published yet, try again once refresh_ttl is up
+					continue
+				# only as far as the bars we got, so a late publish is picked up next time
+				hi = float(quotes['date'][-1])
+
+			new_ranges = add_range(new_ranges, lo, hi)
+
+		# cols only cover the requested range, the store may hold more
+		nothing = not meta.get('rows') and not fetched
+
+		if attempted:
+			if failed or nothing:
+				# errors, or a symbol with no history at all (dead / delisted / typo)
+				record_failure(symbol)
+			elif fetched:
+				clear_failure(symbol)
+
+		if nothing and backoff:
+			raise DataError("%s history unavailable, not retrying until %s" % (symbol, time.ctime(backoff)))
+		if nothing and failed:
+			print("ERROR: cannot retrieve quotes, and no relevant data in cache")
+			raise DataError("Network down?")
+		if nothing and attempted:
+			raise DataError("no history for %s" % symbol)
+		if failed:
+			print("WARNING: cannot retrieve some quotes for %s.  Cached data still available" % symbol)
+
+		self.meta = meta
+		self.columns = cols
+
+		if new_ranges == ranges and not fetched and meta.get('checked', 0) == checked and 'ranges' in meta:
+			# it's all in the cache
+			return
+
+		meta['ranges'] = new_ranges
+		if new_ranges:
+			meta['date_low'] = new_ranges[0][0]
+			meta['date_high'] = new_ranges[-1][1]
+
+		new = mdstore.concat(*fetched) if fetched else mdstore.to_columns([])
+		if ranges and (not fetched or new['date'].min() > ranges[-1][1]):
+			# the common daily case, all past anything stored, write only the new bars
+			order = new['date'].argsort(kind='mergesort')
+			new = dict([(name, new[name][order]) for name in mdstore.columns])
+			self.store.append(meta, new)
+		elif fetched:
+			# early data or gap fill, merged in by date (rows already stored win)
+			self.store.merge(meta, new)
+		else:
+			# nothing stored yet and nothing to store
+			return
 
-		# write new cache file
-		if data['hloc']:
-			f = open(symfname, 'w')
-			f.write(json.dumps(data))
-			f.close()
+		# read back just the requested range rather than keeping a copy of the history
+		(self.meta, self.columns) = self.store.load(self.date_from, self.date_to)
 
 
-	def get_data_from_yahoo (self, date_from, date_to):
+	def get_data_from_provider (self, date_from, date_to):
 		"""
 		date args are already nums from dates.date2num by the time we get here
+		returns a dict of column arrays (see mdstore.columns), oldest first,
+		or None if the provider keeps failing
 		"""
 
 		date_from = dates.num2date(date_from)
 		date_to = dates.num2date(date_to)
-		quotes = []
+		quotes = mdstore.to_columns([])
 
 		strikes = 0
 
-		while strikes < 10:
+		while strikes < fetch_attempts:
+			if strikes:
+				# back off, with jitter so a batch of prefetch threads don't retry in lockstep
+				time.sleep(random.uniform(0, min(retry_cap, retry_base * 2 ** strikes)))
 			try:
-				quotes = quotes_historical_yahoo(self.symbol, date_from, date_to)
+				quotes = provider.get().history_columns(self.symbol, date_from, date_to)
 				break
 			except (urllib2.HTTPError, urllib2.URLError), err:
 				# friendly way of saying input does not compute
@@ -179,31 +529,145 @@ class mdcache (object):
 		if strikes:
 			print("History data retrieval failed %d times for %s" % (strikes, self.symbol))
 			traceback.print_exc(err)
+			if strikes == fetch_attempts:
+				# distinguish giving up from an empty range
+				return None
 
 		return quotes
 	
 
+	def get_columns (self):
+		"""
+		returns a dict of per-column float64 arrays (see mdstore.columns) for the requested date range
+		these are views onto the cache, not copies, and must not be modified
+		"""
+		cols = self.columns
+		# columns are sorted by date, so bisect the requested range instead of scanning it
+		lo = cols['date'].searchsorted(self.date_from, side='left')
+		hi = cols['date'].searchsorted(self.date_to, side='right')
+
+		return dict([(name, cols[name][lo:hi]) for name in mdstore.columns])
+
+
 	def get_data (self):
 		"""
-		returns array of (time, open, close, high, low, ...) tuples
+		returns array of (time, open, close, high, low, volume) tuples
+		prices are 2 place Decimals, built lazily as rows are accessed (see DecimalView)
 		"""
+		datenums = self.columns['date']
+		lo = datenums.searchsorted(self.date_from, side='left')
+		hi = datenums.searchsorted(self.date_to, side='right')
 
-		res = []
+		# the memo lives with the shared history, so rows converted for one caller are reused by the next
+		return DecimalView(self.columns, lo, hi, self.memo)
+
+
+
+class RowMemo (object):
+	"""
+	rows converted by DecimalView, at most size of them, first converted first dropped
+	(callers walk histories forward).  safe to share between threads without a lock
+	"""
+
+	def __init__ (self, size):
+		self.size = size
+		self.rows = {}
+		self.order = deque()
+
+
+	def __len__ (self):
+		return len(self.rows)
+
+
+	def get (self, i):
+		return self.rows.get(i)
+
+
+	def put (self, i, row):
+		self.rows[i] = row
+		self.order.append(i)
+		while len(self.order) > self.size:
+			self.rows.pop(self.order.popleft(), None)
+
+
+
+class DecimalView (object):
+	"""
+	read-only sequence of (time, open, close, high, low, volume) tuples over column arrays
+
+	rows are converted to Decimal on first access and remembered (up to memo_rows of them,
+	see RowMemo), so callers that only look at the tail of a long history don't pay for
+	the rest of it.  slices share the converted rows with the view they came from.  adding
+	a list gives back a plain list
+	"""
+
+	def __init__ (self, cols, start=0, stop=None, memo=None):
+		self.cols = cols
+		if stop is None:
+			stop = len(cols['date'])
+		self.start = start
+		self.stop = max(start, stop)
+		if memo is None:
+			memo = RowMemo(memo_rows)
+		self.memo = memo
+
+
+	def row (self, i):
+		"""
+		i is an absolute index into the underlying columns
+		"""
+		r = self.memo.get(i)
+		if r is not None:
+			return r
+
+		cols = self.cols
+		r = (
+				float(cols['date'][i]),
+				D("%.2f" % cols['open'][i]),
+				D("%.2f" % cols['close'][i]),
+				D("%.2f" % cols['high'][i]),
+				D("%.2f" % cols['low'][i]),
+				int(cols['volume'][i])
+			)
+		self.memo.put(i, r)
+		return r
+
+
+	def __len__ (self):
+		return self.stop - self.start
+
+
+	def __getitem__ (self, item):
+		if isinstance(item, slice):
+			(start, stop, step) = item.indices(len(self))
+			if step != 1:
+				return [self[i] for i in range(start, stop, step)]
+			return DecimalView(self.cols, self.start + start, self.start + stop, self.memo)
+
+		if item < 0:
+			item += len(self)
+		if item < 0 or item >= len(self):
+			raise IndexError("DecimalView index out of range")
+		return self.row(self.start + item)
+
+
+	def __iter__ (self):
+		for i in xrange(self.start, self.stop):
+			yield self.row(i)
+
+
+	def __reversed__ (self):
+		for i in xrange(self.stop - 1, self.start - 1, -1):
+			yield self.row(i)
+
+
+	def __add__ (self, other):
+		return self.tolist() + list(other)
 
-		for d in self.data['hloc']:
-			# time, open, close, high, low, volume
-			try:
-				(t, o, c, h, l, v) = d
-			except Exception, e:
-				print("%s: %s" % (e, d))
-				raise
-			if t >= self.date_from and t <= self.date_to:
-				o = D("%.2f" % o)
-				c = D("%.2f" % c)
-				h = D("%.2f" % h)
-				l = D("%.2f" % l)
 
-				res += [(t, o, c, h, l, v)]
+	def __radd__ (self, other):
+		return list(other) + self.tolist()
 
-		return res
 
+	def tolist (self):
+		return list(self)
@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+
+"""
+on-disk storage backend for mdcache
+
+each symbol lives in its own directory under the cache dir, holding one
+fixed-width little endian float64 file per column plus a small json meta file.
+columns are opened via mmap so a reader only pages in the rows it touches
+
+bars added after the last bar stored are appended to the end of each column
+file, and only count once the meta's row total takes them in
+
+for large symbol universes a single sqlite database can be used instead (set
+backend = 'sqlite', or VEST_MDSTORE=sqlite in the environment).  existing
+caches are converted with:
+
+	python mdstore.py migrate [sqlite|columns] [cachedir]
+"""
+
+import os, sys, json, shutil, thread, threading, fcntl
+import sqlite3
+from contextlib import contextmanager
+import numpy as np
+
+
+# column order matches the (time, open, close, high, low, volume) tuples
+# returned by quotes_historical_yahoo and mdcache.get_data()
+columns = ('date', 'open', 'close', 'high', 'low', 'volume')
+
+dtype = np.dtype('<f8')
+
+# which store class store() hands out, see stores
+backend = os.environ.get('VEST_MDSTORE', 'columns')
+
+# sqlite database file, relative to the cache dir
+sqlite_name = '.mdcache.sqlite'
+
+
+class StoreError (Exception):
+	pass
+
+
+def writer ():
+	"""
+	tag for scratch file names, unique per process and thread so concurrent writers don't collide
+	"""
+	return '%d-%d' % (os.getpid(), thread.get_ident())
+
+
+def to_columns (rows):
+	"""
+	converts a list of (time, open, close, high, low, volume) rows into a dict of column arrays
+	"""
+	if not rows:
+		return dict([(name, np.empty(0, dtype=dtype)) for name in columns])
+
+	table = np.array([r[:len(columns)] for r in rows], dtype=dtype)
+	return dict([(name, table[:,i].copy()) for (i, name) in enumerate(columns)])
+
+
+def concat (*parts):
+	"""
+	joins several column dicts end to end
+	"""
+	return dict([(name, np.concatenate([p[name] for p in parts])) for name in columns])
+
+
+class ColumnStore (object):
+	"""
+	columnar store for one symbol
+
+	<root>/<SYMBOL>/meta		json: rows, ranges (fetched date spans), date_low, date_high, checked
+	<root>/<SYMBOL>/<column>	rows * float64, possibly followed by the remains of an interrupted append
+	<root>/.lock-<SYMBOL>		flock()ed while appending or merging
+	"""
+
+	def __init__ (self, root, symbol):
+		self.root = root
+		self.symbol = symbol.upper()
+		self.path = os.path.join(root, self.symbol)
+
+
+	def exists (self):
+		if os.path.isfile(self.path):
+			# pre-columnar cache file, convert it in place
+			self.migrate_json()
+		return os.path.exists(os.path.join(self.path, 'meta'))
+
+
+	def migrate_json (self):
+		"""
+		replaces a legacy single-file json cache entry with a column store
+		unreadable files are discarded, they will be refetched
+		"""
+		f = open(self.path)
+		try:
+			data = json.loads(f.read())
+		except ValueError, e:
+			# No JSON object could be decoded
+			print("MDERROR -- Recovering by Invalidating %s: %s" % (self.symbol, e))
+			data = None
+		f.close()
+		os.unlink(self.path)
+
+		if data and data['hloc']:
+			meta = {'date_low': data['date_low'], 'date_high': data['date_high']}
+			self.write(meta, to_columns(data['hloc']))
+
+
+	def write_meta (self, meta):
+		fname = os.path.join(self.path, 'meta')
+		tmp = '%s.tmp-%s' % (fname, writer())
+		f = open(tmp, 'w')
+		f.write(json.dumps(meta))
+		f.close()
+		os.rename(tmp, fname)
+
+
+	def read_meta (self):
+		try:
+			f = open(os.path.join(self.path, 'meta'))
+			try:
+				return json.loads(f.read())
+			finally:
+				f.close()
+		except (IOError, ValueError), e:
+			raise StoreError("bad meta for %s: %s" % (self.symbol, e))
+
+
+	def load (self, date_from=None, date_to=None):
+		"""
+		returns (meta, columns) where columns is a dict of read-only memory mapped arrays,
+		optionally only the bars between date nums date_from and date_to
+		"""
+		meta = self.read_meta()
+		rows = meta['rows']
+		cols = {}
+
+		for name in columns:
+			fname = os.path.join(self.path, name)
+			try:
+				size = os.path.getsize(fname)
+			except OSError, e:
+				raise StoreError("missing column for %s: %s" % (self.symbol, e))
+			if size < rows * dtype.itemsize:
+				raise StoreError("truncated %s column for %s" % (name, self.symbol))
+			if rows:
+				cols[name] = np.memmap(fname, dtype=dtype, mode='r', shape=(rows,))
+			else:
+				# mmap refuses empty files
+				cols[name] = np.empty(0, dtype=dtype)
+
+		lo = cols['date'].searchsorted(date_from, side='left') if date_from is not None else 0
+		hi = cols['date'].searchsorted(date_to, side='right') if date_to is not None else rows
+		if (lo, hi) != (0, rows):
+			cols = dict([(name, cols[name][lo:hi]) for name in columns])
+
+		return (meta, cols)
+
+
+	@contextmanager
+	def locked (self):
+		"""
+		holds the symbol's lock file, shutting out other processes (the gui and the alert
+		loop can refresh the same symbol) and other threads, as each open() locks apart
+		"""
+		f = open(os.path.join(self.root, '.lock-%s' % self.symbol), 'a')
+		try:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			yield
+		finally:
+			# closing releases the lock
+			f.close()
+
+
+	def append (self, meta, new):
+		"""
+		adds rows dated after everything already stored
+		only the new rows (and the small meta file) are written
+
+		the rows go on the end of each column file, then the meta takes them into its row
+		count.  readers map only that many rows, so the meta write is the commit point, and
+		whatever an interrupted append left past them is cut off by the next one
+		"""
+		meta = dict(meta)
+		with self.locked():
+			# meta may be stale, another writer can have appended since it was read
+			rows = self.read_meta()['rows']
+			meta['rows'] = rows
+
+			if rows and len(new['date']):
+				last = np.memmap(os.path.join(self.path, 'date'), dtype=dtype, mode='r', shape=(rows,))[-1]
+				keep = np.asarray(new['date']) > last
+				new = dict([(name, np.asarray(new[name])[keep]) for name in columns])
+
+			if len(new['date']):
+				for name in columns:
+					f = open(os.path.join(self.path, name), 'ab')
+					f.truncate(rows * dtype.itemsize)
+					f.write(np.asarray(new[name], dtype=dtype).tostring())
+					f.close()
+				meta['rows'] = rows + len(new['date'])
+
+			self.write_meta(meta)
+
+
+	def merge (self, meta, new):
+		"""
+		adds rows anywhere in the history, rows already stored win over new ones for the same date
+		the columns can only grow at the end, so this rewrites them
+		"""
+		with self.locked():
+			cols = new
+			if self.exists():
+				(unused, stored) = self.load()
+				cols = concat(stored, new)
+			(unused, idx) = np.unique(cols['date'], return_index=True)
+			self.write(meta, dict([(name, cols[name][idx]) for name in columns]))
+
+
+	def write (self, meta, cols):
+		"""
+		full rewrite of the symbol's store
+
+		built in a scratch dir and swapped in, so readers never see a half written store
+		mappings held on the old files stay valid until they are dropped
+		"""
+		meta = dict(meta)
+		meta['rows'] = len(cols['date'])
+
+		# unique per writer, mdcache.prefetch() runs several in one process
+		tag = writer()
+		tmp = os.path.join(self.root, '.tmp-%s-%s' % (self.symbol, tag))
+		if os.path.exists(tmp):
+			shutil.rmtree(tmp)
+		os.mkdir(tmp)
+
+		for name in columns:
+			f = open(os.path.join(tmp, name), 'wb')
+			f.write(np.asarray(cols[name], dtype=dtype).tostring())
+			f.close()
+
+		f = open(os.path.join(tmp, 'meta'), 'w')
+		f.write(json.dumps(meta))
+		f.close()
+
+		old = None
+		if os.path.exists(self.path):
+			old = os.path.join(self.root, '.old-%s-%s' % (self.symbol, tag))
+			os.rename(self.path, old)
+		os.rename(tmp, self.path)
+		if old:
+			shutil.rmtree(old)
+
+
+	def remove (self):
+		if os.path.isdir(self.path):
+			shutil.rmtree(self.path)
+		elif os.path.exists(self.path):
+			os.unlink(self.path)
+
+
+
+class SqliteStore (object):
+	"""
+	store for one symbol in a database shared by all symbols
+
+	bars(symbol, date, open, close, high, low, volume), primary key (symbol, date)
+	meta(symbol, meta) where meta is the same json as ColumnStore's meta file
+	"""
+
+	connections = {}
+	lock = threading.RLock()
+	forked = []		# connections inherited over fork(), see after_fork()
+
+	def __init__ (self, root, symbol):
+		self.root = root
+		self.symbol = symbol.upper()
+		self.db = self.connect(root)
+
+
+	@classmethod
+	def connect (cls, root):
+		"""
+		one connection per database, shared by every thread under cls.lock
+		"""
+		fname = os.path.join(root, sqlite_name)
+		with cls.lock:
+			if fname not in cls.connections:
+				db = sqlite3.connect(fname, check_same_thread=False)
+				db.execute('create table if not exists bars (symbol text not null, date real not null, '
+						'open real, close real, high real, low real, volume real, primary key (symbol, date))')
+				db.execute('create table if not exists meta (symbol text primary key, meta text not null)')
+				db.commit()
+				cls.connections[fname] = db
+			return cls.connections[fname]
+
+
+	def exists (self):
+		with self.lock:
+			return self.db.execute('select 1 from meta where symbol = ?', (self.symbol,)).fetchone() is not None
+
+
+	def read_meta (self):
+		with self.lock:
+			row = self.db.execute('select meta from meta where symbol = ?', (self.symbol,)).fetchone()
+		if row is None:
+			raise StoreError("no meta for %s" % self.symbol)
+		try:
+			return json.loads(row[0])
+		except ValueError, e:
+			raise StoreError("bad meta for %s: %s" % (self.symbol, e))
+
+
+	def write_meta (self, meta):
+		with self.lock:
+			with self.db:
+				self._put_meta(meta)
+
+
+	def _put_meta (self, meta):
+		self.db.execute('insert or replace into meta (symbol, meta) values (?, ?)', (self.symbol, json.dumps(meta)))
+
+
+	def load (self, date_from=None, date_to=None):
+		"""
+		returns (meta, columns), optionally only the bars between date nums date_from and date_to
+		"""
+		meta = self.read_meta()
+		if date_from is None:
+			date_from = float('-inf')
+		if date_to is None:
+			date_to = float('inf')
+		with self.lock:
+			try:
+				rows = self.db.execute('select date, open, close, high, low, volume from bars '
+						'where symbol = ? and date between ? and ? order by date',
+						(self.symbol, date_from, date_to)).fetchall()
+			except sqlite3.DatabaseError, e:
+				raise StoreError("bad bars for %s: %s" % (self.symbol, e))
+		return (meta, to_columns(rows))
+
+
+	def _rows (self, cols):
+		return [(self.symbol,) + r for r in zip(*[np.asarray(cols[name]).tolist() for name in columns])]
+
+
+	def write (self, meta, cols):
+		"""
+		replaces the symbol's bars and meta in one transaction
+		"""
+		meta = dict(meta)
+		meta['rows'] = len(cols['date'])
+		with self.lock:
+			with self.db:
+				self.db.execute('delete from bars where symbol = ?', (self.symbol,))
+				self.db.executemany('insert into bars values (?, ?, ?, ?, ?, ?, ?)', self._rows(cols))
+				self._put_meta(meta)
+
+
+	def _count (self):
+		return self.db.execute('select count(*) from bars where symbol = ?', (self.symbol,)).fetchone()[0]
+
+
+	def append (self, meta, new):
+		"""
+		adds rows (bulk insert) and updates the meta in one transaction
+		"""
+		meta = dict(meta)
+		with self.lock:
+			with self.db:
+				self.db.executemany('insert or replace into bars values (?, ?, ?, ?, ?, ?, ?)', self._rows(new))
+				meta['rows'] = self._count()
+				self._put_meta(meta)
+
+
+	def merge (self, meta, new):
+		"""
+		adds rows anywhere in the history, rows already stored win over new ones for the same date
+		only the new rows are written
+		"""
+		meta = dict(meta)
+		with self.lock:
+			with self.db:
+				self.db.executemany('insert or ignore into bars values (?, ?, ?, ?, ?, ?, ?)', self._rows(new))
+				meta['rows'] = self._count()
+				self._put_meta(meta)
+
+
+	def remove (self):
+		with self.lock:
+			with self.db:
+				self.db.execute('delete from bars where symbol = ?', (self.symbol,))
+				self.db.execute('delete from meta where symbol = ?', (self.symbol,))
+
+
+
+def after_fork ():
+	"""
+	for a forked child process (see mdcache.after_fork())
+	a sqlite connection mustn't be used, or closed, on both sides of a fork(), so the
+	parent's are set aside and the child opens its own
+	"""
+	SqliteStore.forked += SqliteStore.connections.values()
+	SqliteStore.connections = {}
+	SqliteStore.lock = threading.RLock()
+
+
+stores = {
+		'columns':	ColumnStore,
+		'sqlite':	SqliteStore,
+	}
+
+
+def store (root, symbol, kind=None):
+	"""
+	returns the store for symbol under the configured backend (or kind)
+	"""
+	return stores[kind or backend](root, symbol)
+
+
+def entries (root, kind=None):
+	"""
+	returns the symbols held by the configured backend (or kind)
+	"""
+	if (kind or backend) == 'sqlite':
+		db = SqliteStore.connect(root)
+		with SqliteStore.lock:
+			return [str(r[0]) for r in db.execute('select symbol from meta order by symbol')]
+
+	# dot entries are store scratch space
+	return [e for e in os.listdir(root) if not e.startswith('.')]
+
+
+def load_universe (root, date_from=None, date_to=None, kind=None):
+	"""
+	returns a dict of symbol -> columns for every cached symbol, optionally only date_from..date_to
+	with the sqlite backend this is a single indexed query rather than a store open per symbol
+	"""
+	if (kind or backend) != 'sqlite':
+		res = {}
+		for symbol in entries(root, kind):
+			s = ColumnStore(root, symbol)
+			if not s.exists():
+				continue
+			(meta, res[s.symbol]) = s.load(date_from, date_to)
+		return res
+
+	if date_from is None:
+		date_from = float('-inf')
+	if date_to is None:
+		date_to = float('inf')
+
+	db = SqliteStore.connect(root)
+	with SqliteStore.lock:
+		rows = db.execute('select symbol, date, open, close, high, low, volume from bars '
+				'where date between ? and ? order by symbol, date', (date_from, date_to)).fetchall()
+
+	res = {}
+	start = 0
+	for i in range(1, len(rows) + 1):
+		if i == len(rows) or rows[i][0] != rows[start][0]:
+			res[str(rows[start][0])] = to_columns([r[1:] for r in rows[start:i]])
+			start = i
+	return res
+
+
+def migrate (root, kind='sqlite', remove=False):
+	"""
+	copies every cached symbol into the kind store
+	legacy single-file json entries are read too.  remove=True deletes the source once copied
+	returns the number of symbols copied
+	"""
+	if kind == 'sqlite':
+		# sources are json files / column dirs
+		sources = [e for e in os.listdir(root) if not e.startswith('.')]
+		src_kind = 'columns'
+	else:
+		sources = entries(root, 'sqlite')
+		src_kind = 'sqlite'
+
+	count = 0
+	for symbol in sources:
+		src = store(root, symbol, src_kind)
+		if not src.exists():
+			# includes unreadable json entries, which exists() discards
+			continue
+		(meta, cols) = src.load()
+		store(root, symbol, kind).write(meta, cols)
+		if remove:
+			src.remove()
+		count += 1
+		print("%s: %d bars" % (symbol, len(cols['date'])))
+	return count
+
+
+if __name__ == "__main__":
+	args = sys.argv[1:]
+	if not args or args[0] != 'migrate':
+		print("usage: %s migrate [sqlite|columns] [cachedir]" % sys.argv[0])
+		sys.exit(1)
+	kind = 'sqlite'
+	if len(args) > 1:
+		kind = args[1]
+	import mdcache
+	root = mdcache.cachedir
+	if len(args) > 2:
+		root = args[2]
+	print("migrated %d symbols" % migrate(root, kind))
@@ -1,11 +1,50 @@
 #!/usr/bin/env python
 
-import datetime
+import os, datetime, math, json, time
+import multiprocessing
+from bisect import bisect_right
+from itertools import chain
+import numpy as np
 import mdcache
+import fetcher
+import httppool
+from bunch import Bunch
 import matplotlib.dates as dates
 from decimal import Decimal as D
 import gtk, pango	# for text buffer output mode
 
+pennies = D('0.01')
+
+# cell tags of a rendered chart, see Graph.render_grid()
+tag_downtrend = 1
+tag_uptrend = 2
+tag_month = 3
+
+ansi_tags = {
+		0:				'%s',
+		tag_downtrend:	'\033[31m%s\033[0m',
+		tag_uptrend:	'\033[34m%s\033[0m',
+		tag_month:		'\033[7m\033[1m%s\033[0m',
+	}
+
+# saved graph state, see Graph.refresh()
+statedir = os.path.join(mdcache.cachedir, '.pnf')
+state_version = 1
+
+# a saved graph is carried forward until it starts this many days before the data window
+# (which slides a day at a time), then rebuilt from the window
+rebase_days = 30
+
+
+def tag_runs (tags):
+	"""
+	splits a row of cell tags into runs of the same tag
+	yields (start, stop, tag) covering the row
+	"""
+	edges = [0] + list(np.flatnonzero(np.diff(tags)) + 1) + [len(tags)]
+	for (i, j) in zip(edges, edges[1:]):
+		yield (i, j, tags[i])
+
 
 class Column (object):
 	"""
@@ -32,6 +71,232 @@ class Column (object):
 		self.start_date = start_date
 
 
+	def to_state (self):
+		"""
+		json friendly copy of the column, see from_state()
+		"""
+		boxes = [self.high, self.low, self.uptrend, self.downtrend]
+		return [self.marker] + [b is not None and str(b) or None for b in boxes] + [
+				[[mon, str(box)] for (mon, box) in self.months],
+				dates.date2num(self.start_date),
+			]
+
+
+	@classmethod
+	def from_state (cls, state):
+		(marker, high, low, uptrend, downtrend, months, start) = state
+		col = cls(str(marker), D(high), D(low), dates.num2date(start))
+		col.uptrend = uptrend and D(uptrend)
+		col.downtrend = downtrend and D(downtrend)
+		col.months = [(str(mon), D(box)) for (mon, box) in months]
+		return col
+
+
+class BoxGrid (object):
+	"""
+	box values of a graph, lowest first, used like a list
+
+	boxes are only ever added at the ends.  each one keeps a fixed position (0 for the
+	first box, counting down for those added under it and up for those added over it)
+	so the value -> row map stays valid as the grid grows either way, and index() is
+	a dict lookup instead of a scan
+	"""
+
+	def __init__ (self):
+		self.below = []		# boxes under the first one, nearest first
+		self.above = []		# the first box and those over it
+		self.positions = {}	# value -> position of its lowest box
+
+
+	def __len__ (self):
+		return len(self.below) + len(self.above)
+
+
+	def __getitem__ (self, row):
+		if isinstance(row, slice):
+			return [self[i] for i in range(*row.indices(len(self)))]
+		if row < 0:
+			row += len(self)
+		if row < 0 or row >= len(self):
+			raise IndexError("box row out of range")
+		p = row - len(self.below)
+		if p >= 0:
+			return self.above[p]
+		return self.below[-p - 1]
+
+
+	def __contains__ (self, value):
+		return value in self.positions
+
+
+	def __iter__ (self):
+		return chain(reversed(self.below), self.above)
+
+
+	def __reversed__ (self):
+		return chain(reversed(self.above), self.below)
+
+
+	def index (self, value):
+		"""
+		row of the (lowest) box with the given value
+		"""
+		try:
+			return self.positions[value] + len(self.below)
+		except KeyError:
+			raise ValueError("%s is not a box" % value)
+
+
+	def append (self, value):
+		self.positions.setdefault(value, len(self.above))
+		self.above.append(value)
+
+
+	def prepend (self, values):
+		"""
+		adds values (ascending) under the lowest box
+		"""
+		for value in reversed(values):
+			self.below.append(value)
+			self.positions[value] = -len(self.below)
+
+
+
+class BoxScale (object):
+	"""
+	maps prices to box rows and back for a graph
+	row values are worked out in closed form and cached once materialized
+	subclasses provide estimate(value) -> row and compute(row) -> value
+	"""
+
+	def __init__ (self):
+		self.values = {}
+
+
+	def value (self, row):
+		"""
+		box value for a row, any integer
+		"""
+		try:
+			return self.values[row]
+		except KeyError:
+			value = self.values[row] = self.compute(row)
+			return value
+
+
+	def index (self, value):
+		"""
+		row of the highest box at or under value
+		"""
+		row = self.estimate(value)
+		# float / rounding error can leave the estimate a row out either way
+		while self.value(row + 1) <= value:
+			row += 1
+		while self.value(row) > value:
+			row -= 1
+		return row
+
+
+	def label (self, value):
+		"""
+		row label, 2 places unless the box is finer than that
+		"""
+		if value.as_tuple().exponent < -2:
+			return '%7s' % value
+		return '%7.2f' % value
+
+
+	def spec (self):
+		"""
+		json friendly description, equal for scales that give the same boxes
+		"""
+		raise NotImplementedError
+
+
+
+class LogScale (BoxScale):
+	"""
+	boxes a fixed percentage (size) apart with row 0 at base:
+		value(row) = base * (1 + size)^row
+	rounded to the cent, or finer where a box is under a cent tall
+	"""
+
+	def __init__ (self, size=D('0.01'), base=D('1.00')):
+		BoxScale.__init__(self)
+		self.size = D(size)
+		self.base = D(base)
+		self.ratio = 1 + self.size
+		self.log_ratio = math.log(float(self.ratio))
+
+
+	def estimate (self, value):
+		if value <= 0:
+			raise ValueError("log scale boxes need a positive price, not %s" % value)
+		return int(math.floor(math.log(float(value) / float(self.base)) / self.log_ratio))
+
+
+	def compute (self, row):
+		raw = self.base * self.ratio ** row
+		quantum = min(pennies, D(1).scaleb((raw * self.size).adjusted()))
+		return raw.quantize(quantum)
+
+
+	def spec (self):
+		return ['log', str(self.size), str(self.base)]
+
+
+
+class FixedScale (BoxScale):
+	"""
+	traditional box sizes by price band
+	table is a list of (band start, box size) from 0 up, each band a whole number of boxes
+	"""
+
+	table = [
+			(D('0'),		D('0.0625')),
+			(D('0.25'),		D('0.125')),
+			(D('1'),		D('0.25')),
+			(D('5'),		D('0.50')),
+			(D('20'),		D('1')),
+			(D('100'),		D('2')),
+			(D('200'),		D('4')),
+			(D('500'),		D('5')),
+			(D('1000'),		D('50')),
+			(D('25000'),	D('500')),
+		]
+
+	def __init__ (self, table=None):
+		BoxScale.__init__(self)
+		if table is not None:
+			self.table = [(D(start), D(size)) for (start, size) in table]
+
+		self.starts = [start for (start, size) in self.table]
+		# row of each band start
+		self.offsets = [0]
+		for (k, (start, size)) in enumerate(self.table[:-1]):
+			rows = (self.table[k+1][0] - start) / size
+			if rows != int(rows):
+				raise ValueError("box size %s doesn't fit the band from %s" % (size, start))
+			self.offsets += [self.offsets[-1] + int(rows)]
+
+
+	def estimate (self, value):
+		k = max(bisect_right(self.starts, value) - 1, 0)
+		(start, size) = self.table[k]
+		return self.offsets[k] + int((value - start) // size)
+
+
+	def compute (self, row):
+		k = max(bisect_right(self.offsets, row) - 1, 0)
+		(start, size) = self.table[k]
+		return start + (row - self.offsets[k]) * size
+
+
+	def spec (self):
+		return ['fixed', [[str(start), str(size)] for (start, size) in self.table]]
+
+
+
 class Graph (object):
 	"""
 	Top level pnf object
@@ -43,18 +308,31 @@ class Graph (object):
 	columns = None
 	last_close = None
 
-	def __init__ (self, sym, reversal=2):
+	def __init__ (self, sym, reversal=2, scale=None, cached=True):
 		"""
 		sym is the name of the security to graph
 		reversal is the inital box reversal value passed to parse_data()
+		scale is the BoxScale giving the box values, 1% boxes (LogScale()) by default
+		cached picks up the graph saved by the last run and adds the bars since (see refresh()),
+		otherwise it's built from scratch and not saved
 		"""
 		self.box_reversal = reversal
 		self.sym = sym
+		if scale is None:
+			scale = LogScale()
+		self.scale = scale
 		self.columns = []	# list of Column instances
-		self.boxes   = []	# list of box values corresponding to rows
+		self.boxes   = BoxGrid()	# box values corresponding to rows
+		self.base_row = None	# scale row of boxes[0]
+		self.last_month = None	# month of the last bar parsed
+		self.origin = None		# date num of the first bar parsed
+		self.last_bar = None	# last record parsed
 		self.data = mdcache.mdcache(sym).get_data()
 		self.last_close = self.data[-1][2]
-		self.parse_data(reversal=reversal)
+		if cached:
+			self.refresh()
+		else:
+			self.parse_data(reversal=reversal)
 	
 
 	def status (self, current_spot=None):
@@ -189,9 +467,9 @@ class Graph (object):
 		"""
 		col = self.columns[-1]
 		if col.marker == 'O':
-			return self.boxes[self.boxes.index(col.low)+self.box_reversal]
+			return self.box(self.boxes.index(col.low)+self.box_reversal)
 		else:
-			return self.boxes[self.boxes.index(col.high)-self.box_reversal]
+			return self.box(self.boxes.index(col.high)-self.box_reversal)
 	
 
 	def get_continuation (self):
@@ -200,60 +478,42 @@ class Graph (object):
 		"""
 		col = self.columns[-1]
 		if col.marker == 'O':
-			return self.boxes[self.boxes.index(col.low)-1]
+			return self.box(self.boxes.index(col.low)-1)
 		else:
-			return self.boxes[self.boxes.index(col.high)+1]
+			return self.box(self.boxes.index(col.high)+1)
+
+
+	def box (self, row):
+		"""
+		value of the box at row (as in self.boxes), which may be past either end of them
+		"""
+		return self.scale.value(self.base_row + row)
 
 
 	def fit_value (self, value, descending=False):
 		"""
-		takes a Decimal input and returns the appropriate box for it
-		based on box sizing.  Creates new boxes as needed
-		"""
-		pennies = D('0.01')
-		# FIXME: assuming 1% box size for now
-		if not self.boxes:
-			target = value
-			self.boxes.append(value)
-			# add a header row
-			target *= D('1.01')
-			target = target.quantize(pennies)
-			self.boxes += [target]
-			return value
+		takes a Decimal input and returns the appropriate box for it: the highest box
+		at or under value, or with descending the lowest box over it.  box values come
+		from self.scale.  Creates new boxes as needed, with a header row over the top one
+		"""
+		row = self.scale.index(value)
+		if descending:
+			row += 1
+
+		if self.base_row is None:
+			self.base_row = row
+			self.boxes.append(self.scale.value(row))
 
-		if value < self.boxes[0]:
+		if row < self.base_row:
 			# need more boxes under the low point
-			target = self.boxes[0]
-			new_boxes = []
-			while value < target:
-				target *= D('0.99')
-				target = target.quantize(pennies)
-				new_boxes = [target] + new_boxes
-			self.boxes = new_boxes + self.boxes
-			return self.boxes[1]
-		
-		if value >= self.boxes[-1]:
-			# need more boxes after the high point
-			target = self.boxes[-1]
-			while value > target:
-				target *= D('1.01')
-				target = target.quantize(pennies)
-				self.boxes += [target]
-			# add a header row
-			target *= D('1.01')
-			target = target.quantize(pennies)
-			self.boxes += [target]
-			return self.boxes[-2]
-
-		# somewhere in the existing range already
-		last_box = self.boxes[0]
-		for box in self.boxes[1:]:
-			if box > value:
-				if descending:
-					return box
-				else:
-					return last_box
-			last_box = box
+			self.boxes.prepend([self.scale.value(r) for r in range(row, self.base_row)])
+			self.base_row = row
+
+		# need more boxes after the high point, plus a header row
+		for r in range(self.base_row + len(self.boxes), row + 2):
+			self.boxes.append(self.scale.value(r))
+
+		return self.scale.value(row)
 	
 
 	def parse_data (self, reversal=2):
@@ -261,21 +521,44 @@ class Graph (object):
 		takes data and builds out box / column pnf data based on supplied reversal param
 		"""
 		# reset graph data
-		self.boxes = []
+		self.boxes = BoxGrid()
+		self.base_row = None
 		self.columns = []
+		self.last_month = None
 
-		curr_col = last_month = None
+		self.add_bars(self.data, reversal=reversal)
 
-		for record in self.data:
+		# do trendlines
+		self.apply_trendlines()
+
+
+	def add_bars (self, records, reversal=2):
+		"""
+		parses records (as in self.data) into the graph, carrying on from the active column
+		trendlines are left to the caller
+		"""
+		if self.columns:
+			# the active column may yet continue
+			curr_col = self.columns.pop()
+		else:
+			curr_col = None
+		last_month = self.last_month
+		record = None
+
+		for record in records:
 			(datenum, x_open, x_close, x_high, x_low, x_vol) = record
 			record_date = dates.num2date(datenum)
 			curr_month = record_date.month
 
 			if not curr_col:
 				# first record, assume it's an up col
+				self.origin = datenum
 				last_month = curr_month
 				box_high = self.fit_value(x_high)
 				box_low = self.fit_value(x_low, descending=True)		# desc first time just to establish range based on the day
+				if box_low > box_high:
+					# high and low in the same box
+					box_low = box_high
 				curr_col = Column('X', box_high, box_low, record_date)
 				continue
 			
@@ -292,7 +575,7 @@ class Graph (object):
 						# reverse to 'O'
 						self.columns.append(curr_col)
 						ind_col_high = self.boxes.index(curr_col.high)
-						curr_col = Column('O', self.boxes[ind_col_high-1], box_low, record_date)
+						curr_col = Column('O', self.box(ind_col_high-1), box_low, record_date)
 					else:
 						# NOP
 						pass
@@ -310,7 +593,7 @@ class Graph (object):
 						# reverse to 'X'
 						self.columns.append(curr_col)
 						ind_col_low = self.boxes.index(curr_col.low)
-						curr_col = Column('X', box_high, self.boxes[ind_col_low+1], record_date)
+						curr_col = Column('X', box_high, self.box(ind_col_low+1), record_date)
 					else:
 						# NOP
 						pass
@@ -328,9 +611,129 @@ class Graph (object):
 
 		# append final col
 		self.columns.append(curr_col)
+		self.last_month = last_month
+		if record is not None:
+			self.last_bar = record
 
-		# do trendlines
+
+	def update (self, records):
+		"""
+		adds records (as in self.data) newer than any parsed so far, costs O(len(records))
+		plus redrawing the trendlines, which only depend on the columns
+		"""
+		if not len(records):
+			return
+		self.add_bars(records, reversal=self.box_reversal)
+		for col in self.columns:
+			col.uptrend = col.downtrend = None
 		self.apply_trendlines()
+
+
+	def state_file (self):
+		return os.path.join(statedir, '%s.json' % self.sym.upper())
+
+
+	def to_state (self):
+		"""
+		json friendly copy of everything needed to carry on parsing, see restore()
+		"""
+		return {
+				'version':		state_version,
+				'reversal':		self.box_reversal,
+				'scale':		self.scale.spec(),
+				'base_row':		self.base_row,
+				'rows':			len(self.boxes),
+				'columns':		[col.to_state() for col in self.columns],
+				'last_month':	self.last_month,
+				'origin':		self.origin,
+				'last_bar':		[self.last_bar[0]] + [str(x) for x in self.last_bar[1:5]],
+			}
+
+
+	def restore (self, state):
+		"""
+		takes on a saved graph if it can be carried forward to self.data, i.e. it was drawn
+		the same way, starts no more than rebase_days before self.data and its last bar is
+		still there unchanged
+
+		returns the records of self.data it doesn't cover yet, or None (graph untouched)
+		if it can't be used
+		"""
+		if state.get('version') != state_version:
+			return None
+		if state['reversal'] != self.box_reversal or state['scale'] != self.scale.spec():
+			return None
+
+		first = self.data[0][0]
+		if not first - rebase_days <= state['origin'] <= first:
+			return None
+
+		last_bar = [state['last_bar'][0]] + [D(x) for x in state['last_bar'][1:]]
+		i = len(self.data)
+		while i and self.data[i-1][0] > last_bar[0]:
+			i -= 1
+		if not i or list(self.data[i-1][:5]) != last_bar:
+			# history rewritten under us
+			return None
+
+		self.base_row = state['base_row']
+		self.boxes = BoxGrid()
+		for r in range(state['rows']):
+			self.boxes.append(self.scale.value(self.base_row + r))
+		self.columns = [Column.from_state(col) for col in state['columns']]
+		self.last_month = state['last_month']
+		self.origin = state['origin']
+		self.last_bar = tuple(last_bar)
+		return self.data[i:]
+
+
+	def refresh (self):
+		"""
+		brings the graph up to date with self.data, starting from the state saved by the
+		last refresh() of this symbol when it can (see restore()) and from scratch when not,
+		then saves it for the next one
+		"""
+		try:
+			f = open(self.state_file())
+			try:
+				state = json.loads(f.read())
+			finally:
+				f.close()
+		except (IOError, ValueError):
+			state = None
+
+		new = None
+		if state is not None:
+			try:
+				new = self.restore(state)
+			except (KeyError, TypeError, ValueError):
+				# from some other version
+				new = None
+
+		if new is None:
+			self.parse_data(reversal=self.box_reversal)
+		elif len(new):
+			self.update(new)
+		else:
+			# nothing new
+			return
+
+		try:
+			if not os.path.isdir(statedir):
+				try:
+					os.makedirs(statedir)
+				except OSError:
+					# another process got there first?
+					if not os.path.isdir(statedir):
+						raise
+			tmp = '%s.%d.tmp' % (self.state_file(), os.getpid())
+			f = open(tmp, 'w')
+			f.write(json.dumps(self.to_state()))
+			f.close()
+			os.rename(tmp, self.state_file())
+		except (IOError, OSError), e:
+			# still have the graph, it'll just be rebuilt next time
+			print("Error saving %s pnf state: %s" % (self.sym, e))
 	
 
 	def apply_trendlines (self):
@@ -346,6 +749,7 @@ class Graph (object):
 				if not col.uptrend and (col.high > prev_col.high):
 					# breakout, acquire start of new uptrend line
 					low_col = self.columns[i-1]	# default to prior col
+					low_idx = i-1
 					j = i-3	# start scanning 2 back from default
 					while j >= 0:
 						r_col = self.columns[j]
@@ -355,16 +759,17 @@ class Graph (object):
 						if r_col.low < low_col.low:
 							# new low, start here?
 							low_col = r_col
+							low_idx = j
 						j -= 2	# skip X cols
 
 					# start drawing the uptrend line with low_col
 					trendline_idx = self.boxes.index(low_col.low)-1
-					j = self.columns.index(low_col)
+					j = low_idx
 					if (i-j) > 1:	# don't draw if it started on prior col
 						while j < ncols:
 							curr_col = self.columns[j]
 							if self.boxes.index(curr_col.low) > trendline_idx:
-								curr_col.uptrend = self.boxes[trendline_idx]
+								curr_col.uptrend = self.box(trendline_idx)
 								trendline_idx += 1
 							else:
 								# trendline violated, stop
@@ -375,6 +780,7 @@ class Graph (object):
 				if not col.downtrend and (col.low < prev_col.low):
 					# breakdown, acquire start of new downtrend line
 					high_col = self.columns[i-1]	# default to prior col
+					high_idx = i-1
 					j = i-3	# start scanning 2 back from default
 					while j >= 0:
 						r_col = self.columns[j]
@@ -384,16 +790,17 @@ class Graph (object):
 						if r_col.high > high_col.high:
 							# new high, start here?
 							high_col = r_col
+							high_idx = j
 						j -= 2	# skip O cols
 
 					# start drawing the downtrend line with high_col
 					trendline_idx = self.boxes.index(high_col.high)+1
-					j = self.columns.index(high_col)
+					j = high_idx
 					if (i-j) > 1:	# don't draw if it started on prior col
 						while j < ncols:
 							curr_col = self.columns[j]
 							if self.boxes.index(curr_col.high) < trendline_idx:
-								curr_col.downtrend = self.boxes[trendline_idx]
+								curr_col.downtrend = self.box(trendline_idx)
 								trendline_idx -= 1
 							else:
 								# trendline violated, stop
@@ -403,110 +810,224 @@ class Graph (object):
 			i += 1
 
 
-	def get_output (self, style=''):
+	def render_grid (self, columns, rows):
+		"""
+		chart body for the given columns (Column list) and rows (slice of self.boxes), top row first
+		returns (chars, tags): 2d arrays of the cell characters and their tags, one of
+		tag_names (0 for none).  in a cell a downtrend beats an uptrend beats a month label
+		beats the column's marker
+		"""
+		boxes = self.boxes
+		(first, stop) = (rows.start, rows.stop)
+		nrows = stop - first
+
+		def row_of (value):
+			# row in the chart (0 at the top), None if it's not shown
+			try:
+				r = boxes.index(value) - first
+			except ValueError:
+				return None
+			if 0 <= r < nrows:
+				return nrows - 1 - r
+			return None
+
+		# markers, a span per column
+		top = np.array([nrows - 1 - (boxes.index(col.high) - first) for col in columns], dtype=int)
+		bottom = np.array([nrows - 1 - (boxes.index(col.low) - first) for col in columns], dtype=int)
+		markers = np.array([col.marker for col in columns], dtype='S1')
+		r = np.arange(nrows)[:, None]
+		chars = np.where((r >= top) & (r <= bottom), markers, ' ').astype('S1')
+		tags = np.zeros(chars.shape, dtype=np.int8)
+
+		# labels and trendlines, lowest precedence first
+		for (c, col) in enumerate(columns):
+			for (mon, mon_box) in reversed(col.months):
+				r = row_of(mon_box)
+				if r is not None:
+					chars[r, c] = mon
+					tags[r, c] = tag_month
+			for (value, tag) in ((col.uptrend, tag_uptrend), (col.downtrend, tag_downtrend)):
+				if value is None:
+					continue
+				r = row_of(value)
+				if r is not None:
+					chars[r, c] = '+'
+					tags[r, c] = tag
+
+		return (chars, tags)
+
+
+	def get_output (self, style='', columns=None):
 		"""
 		build ascii representation of the graph data
 
 		style: color support.  supported: 'ansi', 'pango'
 		simple ascii with no color used by default
 
+		columns: only draw the last this many columns, and only the rows they (and the
+		spot) reach.  all of them by default
+
 		When using pango, a gtk text buffer is returned instead of a string
 		"""
 		spot = self.last_close
 		last_marker = self.columns[-1].marker
 		going_down = (last_marker == 'X' and spot < self.columns[-1].high) or (last_marker == 'O' and spot <= self.columns[-1].low)
 		spot_box = self.fit_value(spot, descending=going_down)
-		output = self.explain() + "\n\t\t" + ' ' * (len(self.columns)/2 - len(self.sym)/2) + "%s" % self.sym.upper() + "\n"
+
+		shown = self.columns
+		rows = slice(0, len(self.boxes))
+		if columns is not None:
+			shown = self.columns[max(len(self.columns) - columns, 0):]
+			values = [spot_box]
+			for col in shown:
+				values += [col.high, col.low]
+				values += [v for v in (col.uptrend, col.downtrend) if v is not None and v in self.boxes]
+			indices = [self.boxes.index(v) for v in values]
+			# plus a header row, as the full graph has
+			rows = slice(min(indices), min(max(indices) + 2, len(self.boxes)))
+
+		output = self.explain() + "\n\t\t" + ' ' * (len(shown)/2 - len(self.sym)/2) + "%s" % self.sym.upper() + "\n"
+		(chars, tags) = self.render_grid(shown, rows)
+		labels = [self.scale.label(box) for box in self.boxes[rows]]
+		labels.reverse()
+		spot_row = self.boxes.index(spot_box)
+		spot_row = rows.stop - 1 - spot_row
 
 		if style == 'pango':
 			textbuf = gtk.TextBuffer()
-			tag_downtrend = textbuf.create_tag("dt", foreground='#FF0000')
-			tag_uptrend = textbuf.create_tag("ut", foreground='#0000FF')
-			tag_month = textbuf.create_tag("mon", foreground='#FFFFFF', background='#000000', weight=pango.WEIGHT_BOLD)
-			tag_spot  = textbuf.create_tag("spot", foreground='#FF0000', weight=pango.WEIGHT_BOLD)
-			pos = textbuf.get_end_iter()
-			textbuf.insert(pos, output)
-
-		row = ''
-		for box in self.boxes.__reversed__():
-			row += "%7.2f\t\t" % box
-			if style == 'pango':
-				pos = textbuf.get_end_iter()
-				textbuf.insert(pos, "%7.2f\t\t" % box)
-			for col in self.columns:
-				if box == col.downtrend:
-					if style == 'ansi':
-						row += "\033[31m+\033[0m"
-					elif style == 'pango':
-						pos = textbuf.get_end_iter()
-						textbuf.insert_with_tags(pos, "+", tag_downtrend)
-					else:
-						row += "+"
-					continue
-				if box == col.uptrend:
-					if style == 'ansi':
-						row += "\033[34m+\033[0m"
-					elif style == 'pango':
-						pos = textbuf.get_end_iter()
-						textbuf.insert_with_tags(pos, "+", tag_uptrend)
-					else:
-						row += "+"
-					continue
-				if col.months:
-					mark_month = False
-					for mon, mon_box in col.months:
-						if mon_box == box:
-							mark_month = True
-							if style == 'ansi':
-								row += "\033[7m\033[1m%s\033[0m" % mon
-							elif style == 'pango':
-								pos = textbuf.get_end_iter()
-								textbuf.insert_with_tags(pos, "%s" % mon, tag_month)
-							else:
-								row += "%s" % mon
-							break
-					if mark_month:
-						continue
-
-				if col.high >= box and col.low <= box:
-					row += col.marker
-					if style == 'pango':
-						pos = textbuf.get_end_iter()
-						textbuf.insert(pos, col.marker)
+			tag_objs = {
+					tag_downtrend:	textbuf.create_tag("dt", foreground='#FF0000'),
+					tag_uptrend:	textbuf.create_tag("ut", foreground='#0000FF'),
+					tag_month:		textbuf.create_tag("mon", foreground='#FFFFFF', background='#000000', weight=pango.WEIGHT_BOLD),
+				}
+			tag_spot = textbuf.create_tag("spot", foreground='#FF0000', weight=pango.WEIGHT_BOLD)
+			# untagged text is held back and inserted in one go before the next tagged run
+			pending = [output]
+			def flush ():
+				textbuf.insert(textbuf.get_end_iter(), ''.join(pending))
+				del pending[:]
+
+		lines = [output]
+		for (r, label) in enumerate(labels):
+			cells = chars[r].tostring()
+			runs = tags[r]
+			if style == 'ansi':
+				if runs.any():
+					cells = ''.join([ansi_tags[tag] % cells[i:j] for (i, j, tag) in tag_runs(runs)])
+				if r == spot_row:
+					tail = "\t\033[31m\033[1m%s\033[0m" % label
 				else:
-					row += ' '
-					if style == 'pango':
-						pos = textbuf.get_end_iter()
-						textbuf.insert(pos, ' ')
-
-			if box == spot_box:
-				if style == 'ansi':
-					row += "\t\033[31m\033[1m%7.2f\033[0m" % box
-				elif style == 'pango':
-					pos = textbuf.get_end_iter()
-					textbuf.insert_with_tags(pos, "\t%7.2f" % box, tag_spot)
+					tail = "\t%s" % label
+				lines += ["%s\t\t%s%s\n" % (label, cells, tail)]
+			elif style == 'pango':
+				pending += ["%s\t\t" % label]
+				if runs.any():
+					for (i, j, tag) in tag_runs(runs):
+						if tag:
+							flush()
+							textbuf.insert_with_tags(textbuf.get_end_iter(), cells[i:j], tag_objs[tag])
+						else:
+							pending += [cells[i:j]]
 				else:
-					row += "\t%7.2f" % box
+					pending += [cells]
+				if r == spot_row:
+					flush()
+					textbuf.insert_with_tags(textbuf.get_end_iter(), "\t%s" % label, tag_spot)
+				else:
+					pending += ["\t%s" % label]
+				pending += ["\n"]
 			else:
-				row += "\t%7.2f" % box
-				if style == 'pango':
-					pos = textbuf.get_end_iter()
-					textbuf.insert(pos, "\t%7.2f" % box)
-			output += "%s\n" % row
-			if style == 'pango':
-				pos = textbuf.get_end_iter()
-				textbuf.insert(pos, "\n")
-			row = ''
+				lines += ["%s\t\t%s\t%s\n" % (label, cells, label)]
 
 		if style == 'pango':
+			flush()
 			return textbuf
 
-		return output
+		return ''.join(lines)
 
 		
-	def draw (self, style='ansi'):
+	def draw (self, style='ansi', columns=None):
 		""" output ascii graph """
-		print self.get_output(style=style)
+		print self.get_output(style=style, columns=columns)
+
+
+def _scan_init ():
+	"""
+	scan() pool initializer, the workers are forked from a process with fetch threads,
+	http connections and maybe a sqlite connection of its own (see mdcache.after_fork())
+	"""
+	mdcache.after_fork()
+	httppool.after_fork()
+	fetcher.after_fork()
+
+
+def _scan_one (job):
+	"""
+	scan() worker, runs in a pool process
+	"""
+	(sym, spot, reversal) = job
+	try:
+		g = Graph(sym, reversal=reversal)
+		res = Bunch(
+				status=g.status(current_spot=spot),
+				marker=g.columns[-1].marker,
+				reversal=g.get_reversal(),
+				continuation=g.get_continuation(),
+				error=None,
+			)
+	except Exception, e:
+		# bad data for one symbol mustn't sink the rest of the scan
+		res = Bunch(status=None, marker=None, reversal=None, continuation=None, error=e)
+	return (sym, res)
+
+
+def scan (symbols, spots=None, reversal=2, processes=None, deadline=None):
+	"""
+	builds / updates the graphs for many symbols at once across a pool of processes
+	spots is an optional symbol -> current spot dict, for the imminent reversal check
+	processes defaults to one per cpu, deadline is an absolute time.time() value
+
+	returns symbol -> Bunch of status (the status() tuple), marker (of the active column),
+	reversal and continuation (prices, see get_reversal() / get_continuation()) and error,
+	the exception for a symbol that couldn't be graphed (fetcher.Timeout for those not
+	done by the deadline) in which case the rest are None
+
+	histories already loaded in this process (see mdcache.prefetch()) are shared with
+	the workers
+	"""
+	if spots is None:
+		spots = {}
+	jobs = [(sym, spots.get(sym), reversal) for sym in sorted(set(symbols))]
+
+	if processes == 1 or len(jobs) <= 1:
+		return dict(map(_scan_one, jobs))
+
+	results = {}
+	pool = multiprocessing.Pool(processes, initializer=_scan_init)
+	try:
+		done = pool.imap_unordered(_scan_one, jobs)
+		for unused in jobs:
+			timeout = None
+			if deadline is not None:
+				timeout = max(deadline - time.time(), 0)
+			try:
+				(sym, res) = done.next(timeout)
+			except multiprocessing.TimeoutError:
+				break
+			results[sym] = res
+	finally:
+		if len(results) < len(jobs):
+			pool.terminate()
+		else:
+			pool.close()
+		pool.join()
+
+	for (sym, spot, unused) in jobs:
+		if sym not in results:
+			results[sym] = Bunch(status=None, marker=None, reversal=None, continuation=None,
+					error=fetcher.Timeout("no pnf status by the deadline"))
+
+	return results
 
 
 if __name__ == '__main__':
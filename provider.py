@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+market data providers
+
+everything that goes outside the process for prices goes through the active
+provider: mdcache history, ystockquote spot lookups and bd bullion pages.
+
+	provider.get()			the active provider
+	provider.use(p)			swap it, e.g. provider.use(provider.ReplayProvider('/some/dir'))
+
+setting VEST_REPLAY=<dir> in the environment starts out with a ReplayProvider on
+that directory instead of yahoo, so the alert loop, backtests and benchmarks can
+run deterministically with no network
+"""
+
+import os, re, csv, urllib
+import httppool
+import mdstore
+import ystockquote
+import matplotlib.dates as dates
+
+
+class ProviderError (IOError):
+	"""
+	data not available from the provider
+	an IOError so existing network error handling covers it
+	"""
+	pass
+
+
+# yahoo quotes.csv stat codes are a letter with an optional digit, e.g. 'l1c1v'
+stat_re = re.compile('[a-z][0-9]?')
+
+
+class Provider (object):
+	"""
+	interface for market data sources
+	"""
+
+	def history (self, symbol, date_from, date_to):
+		"""
+		daily bars for symbol between the given datetimes, oldest first
+		returns list of (datenum, open, close, high, low, volume) tuples as from quotes_historical_yahoo
+		"""
+		raise NotImplementedError
+
+
+	def history_columns (self, symbol, date_from, date_to):
+		"""
+		history() as a dict of column arrays (see mdstore.columns), oldest first
+		"""
+		return mdstore.to_columns(self.history(symbol, date_from, date_to))
+
+
+	def quote (self, symbol, stat):
+		"""
+		current quote fields for symbol, stat is a yahoo quotes.csv format string
+		returns the raw csv line, e.g. '12.34,+0.10'
+		"""
+		raise NotImplementedError
+
+
+	def quotes (self, symbols, stat):
+		"""
+		quote() for several symbols at once
+		returns the raw csv lines, one per symbol in the same order.  a symbol the provider
+		has nothing for gets all 'N/A' fields, as yahoo answers for an unknown one, rather
+		than failing the others
+		"""
+		lines = []
+		for symbol in symbols:
+			try:
+				lines += [self.quote(symbol, stat)]
+			except ProviderError:
+				lines += [','.join(['N/A'] * len(stat_re.findall(stat)))]
+		return lines
+
+
+	def page (self, url):
+		"""
+		raw contents of a web page (for scraped quotes, see bd.py)
+		"""
+		raise NotImplementedError
+
+
+
+class YahooProvider (Provider):
+	"""
+	live data from yahoo finance
+	history, quotes and pages go through the shared keep-alive pool (httppool)
+	"""
+
+	quote_url = 'http://finance.yahoo.com/d/quotes.csv?s=%s&f=%s'
+
+	def history (self, symbol, date_from, date_to):
+		rows = list(ystockquote.iter_historical_prices(symbol, date_from.strftime('%Y%m%d'), date_to.strftime('%Y%m%d')))
+		rows.reverse()
+		return rows
+
+
+	def history_columns (self, symbol, date_from, date_to):
+		# parsed as the response streams in, see ystockquote.get_historical_columns()
+		return ystockquote.get_historical_columns(symbol, date_from.strftime('%Y%m%d'), date_to.strftime('%Y%m%d'))
+
+
+	def quote (self, symbol, stat):
+		# a single attempt, retries are up to the caller (see fetcher.retry)
+		return httppool.fetch(self.quote_url % (symbol, stat)).strip().strip('"')
+
+
+	def quotes (self, symbols, stat):
+		# quotes.csv takes a '+' separated symbol list and answers with a line per symbol
+		lines = self.quote('+'.join(symbols), stat).splitlines()
+		if len(lines) != len(symbols):
+			raise ProviderError("expected %d quote lines, got %d" % (len(symbols), len(lines)))
+		return [line.strip().strip('"') for line in lines]
+
+
+	def page (self, url):
+		return httppool.fetch(url)
+
+
+
+class ReplayProvider (Provider):
+	"""
+	serves recorded data from a directory:
+
+	history/<SYMBOL>.csv	yahoo table.csv format (Date,Open,High,Low,Close,Volume[,Adj Close]), any order
+	quotes/<SYMBOL>.csv		one 'stat,value' row per quotes.csv stat code, values as yahoo sends them
+	pages/<url>				page contents, file named by the url-quoted url
+
+	missing quote stats are 'N/A', except the last price (l1) which falls back to the
+	last recorded close.  history is parsed once per symbol and kept.  symbols with no
+	recorded history have no bars
+	"""
+
+	def __init__ (self, root):
+		self.root = root
+		self.histories = {}
+
+
+	def history (self, symbol, date_from, date_to):
+		rows = self.load_history(symbol)
+		lo = dates.date2num(date_from)
+		hi = dates.date2num(date_to)
+		return [r for r in rows if lo <= r[0] <= hi]
+
+
+	def load_history (self, symbol):
+		symbol = symbol.upper()
+		if symbol in self.histories:
+			return self.histories[symbol]
+
+		rows = []
+		fname = os.path.join(self.root, 'history', '%s.csv' % symbol)
+		if not os.path.exists(fname):
+			# unknown symbol, same as yahoo having nothing for the range
+			return rows
+
+		f = open(fname)
+		rows = sorted(ystockquote.parse_historical(f))
+		f.close()
+
+		self.histories[symbol] = rows
+		return rows
+
+
+	def quote (self, symbol, stat):
+		recorded = {}
+		fname = os.path.join(self.root, 'quotes', '%s.csv' % symbol.upper())
+		if os.path.exists(fname):
+			f = open(fname)
+			recorded = dict([row[:2] for row in csv.reader(f) if len(row) >= 2])
+			f.close()
+
+		values = []
+		for code in stat_re.findall(stat):
+			if code in recorded:
+				values += [recorded[code]]
+			elif code == 'l1':
+				rows = self.load_history(symbol)
+				if not rows:
+					raise ProviderError("no recorded price for %s" % symbol)
+				values += ['%.2f' % rows[-1][2]]
+			else:
+				values += ['N/A']
+
+		return ','.join(values).strip('"')
+
+
+	def page (self, url):
+		fname = os.path.join(self.root, 'pages', urllib.quote(url, safe=''))
+		if not os.path.exists(fname):
+			raise ProviderError("no recorded page for %s" % url)
+		f = open(fname)
+		html = f.read()
+		f.close()
+		return html
+
+
+
+active = None
+
+def get ():
+	"""
+	returns the active provider
+	"""
+	global active
+	if active is None:
+		if os.environ.get('VEST_REPLAY'):
+			active = ReplayProvider(os.environ['VEST_REPLAY'])
+		else:
+			active = YahooProvider()
+	return active
+
+
+def use (p):
+	"""
+	makes p the active provider, returns the previous one
+	"""
+	global active
+	prev = active
+	active = p
+	return prev
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+process-wide cache of spot prices and quote details, shared by the alerts,
+the gui and the pnf table
+
+a quote younger than ttl seconds is served as is.  up to stale_ttl it is still
+served, but a background refresh is started so the next caller gets a new one.
+anything older (or never seen) is fetched before returning.  stats counts how
+each lookup was answered
+"""
+
+import time, threading
+import ystockquote
+
+
+ttl = 60
+stale_ttl = 15 * 60
+
+stats = {'hits': 0, 'stale': 0, 'misses': 0}
+
+prices = {}			# SYMBOL -> (Decimal, fetched at)
+details = {}		# SYMBOL -> (get_all() dict, fetched at)
+refreshing = set()	# (kind, SYMBOL) with a background refresh in flight
+lock = threading.Lock()
+
+
+def _lookup (cache, kind, symbols):
+	"""
+	sorts symbols into fresh / stale / missing against cache, counting stats
+	returns (found, missing, stale): found is symbol -> cached value (stale ones included),
+	stale lists the found symbols this caller should refresh in the background
+	"""
+	now = time.time()
+	found = {}
+	missing = []
+	stale = []
+	with lock:
+		for symbol in symbols:
+			entry = cache.get(symbol.upper())
+			age = entry and now - entry[1]
+			if entry is None or age > stale_ttl:
+				stats['misses'] += 1
+				missing += [symbol]
+				continue
+			found[symbol] = entry[0]
+			if age <= ttl:
+				stats['hits'] += 1
+			else:
+				stats['stale'] += 1
+				if (kind, symbol.upper()) not in refreshing:
+					refreshing.add((kind, symbol.upper()))
+					stale += [symbol]
+	return (found, missing, stale)
+
+
+def _store (cache, values):
+	now = time.time()
+	with lock:
+		for (symbol, value) in values.items():
+			cache[symbol.upper()] = (value, now)
+
+
+def _refresh (kind, symbols):
+	"""
+	background revalidation, runs in its own thread
+	"""
+	try:
+		if kind == 'price':
+			_store(prices, ystockquote.get_prices(symbols))
+		else:
+			for symbol in symbols:
+				_store_detail(symbol, ystockquote.get_all(symbol))
+	except Exception, e:
+		# keep serving the stale value until it expires
+		print("Error refreshing %s quotes: %s" % (kind, e))
+	finally:
+		with lock:
+			for symbol in symbols:
+				refreshing.discard((kind, symbol.upper()))
+
+
+def _revalidate (kind, symbols):
+	if symbols:
+		t = threading.Thread(target=_refresh, args=(kind, symbols))
+		t.daemon = True
+		t.start()
+
+
+def _store_detail (symbol, data):
+	_store(details, {symbol: data})
+	if data.get('price') is not None:
+		# the detail carries a price too
+		_store(prices, {symbol: data['price']})
+
+
+def get_prices (symbols, deadline=None):
+	"""
+	cached ystockquote.get_prices(), symbols not in the cache are fetched in one go
+	deadline is passed on to the fetch, see fetcher.py
+	returns symbol -> Decimal, leaving out symbols whose price couldn't be had
+	"""
+	(found, missing, stale) = _lookup(prices, 'price', symbols)
+	if missing:
+		fetched = ystockquote.get_prices(missing, deadline=deadline)
+		_store(prices, fetched)
+		found.update(fetched)
+	_revalidate('price', stale)
+	return found
+
+
+def get_price (symbol, deadline=None):
+	"""
+	cached ystockquote.get_price(), raises as that does on a miss that can't be fetched
+	"""
+	(found, missing, stale) = _lookup(prices, 'price', [symbol])
+	if missing:
+		value = ystockquote.get_price(symbol, deadline=deadline)
+		_store(prices, {symbol: value})
+		return value
+	_revalidate('price', stale)
+	return found[symbol]
+
+
+def get_all (symbol):
+	"""
+	cached ystockquote.get_all(), returns a copy the caller may keep
+	"""
+	(found, missing, stale) = _lookup(details, 'detail', [symbol])
+	if missing:
+		data = ystockquote.get_all(symbol)
+		_store_detail(symbol, data)
+		return dict(data)
+	_revalidate('detail', stale)
+	return dict(found[symbol])
+
+
+def clear ():
+	with lock:
+		prices.clear()
+		details.clear()
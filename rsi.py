@@ -5,36 +5,137 @@
 
 import numpy as np
 
+try:
+	from scipy.signal import lfilter
+except ImportError:
+	lfilter = None
+
+
+# bars per step of the closed form smoothing used without scipy, see wilder()
+block = 256
+
+
+def level (up, down):
+	"""
+	rsi from average up / down moves: 100 - 100 / (1 + up / down)
+	100 when there are no down moves at all, 50 when there are no moves either way
+	"""
+	up = np.asarray(up, dtype=np.float64)
+	down = np.asarray(down, dtype=np.float64)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		res = 100. - 100. / (1. + up / down)
+	return np.where(down == 0, np.where(up > 0, 100., 50.), res)
+
+
+def wilder (x, y0, n):
+	"""
+	wilder smoothing along the last axis of x: y[i] = (y[i-1] * (n-1) + x[i]) / n, y[-1] = y0
+	a first order linear filter, run by scipy's lfilter when available
+
+	otherwise in closed form a block at a time,
+		y[k] = a^(k+1) * (y[-1] + sum(x[j] / a^(j+1), j <= k) / n),  a = (n-1) / n
+	the block keeps a^-(j+1) well inside float range, and x >= 0 here so the sum loses nothing
+	"""
+	a = (n - 1.) / n
+	y0 = np.asarray(y0, dtype=np.float64)
+
+	if lfilter is not None:
+		(y, zf) = lfilter([1. / n], [1., -a], x, axis=-1, zi=(a * y0)[..., None])
+		return y
+
+	if a == 0:
+		# n == 1, no memory
+		return x / float(n)
+
+	y = np.empty_like(x)
+	prev = y0
+	for start in range(0, x.shape[-1], block):
+		chunk = x[..., start:start + block]
+		powers = a ** np.arange(1, chunk.shape[-1] + 1)
+		y[..., start:start + block] = powers * (prev[..., None] + np.cumsum(chunk / powers, axis=-1) / n)
+		prev = y[..., start + chunk.shape[-1] - 1]
+	return y
+
+
+def smoothed (closes, n):
+	"""
+	rsi for each row of a 2d float array of closes
+	returns (rsi, up, down) with the final average up / down moves per row
+	"""
+	(rows, count) = closes.shape
+	res = np.zeros_like(closes)
+	deltas = np.diff(closes, axis=1) if count else closes
+
+	# N.B. the seed is n+1 deltas over n, and its last two are then smoothed in again
+	seed = deltas[:, :n+1]
+	up = np.where(seed >= 0, seed, 0.).sum(axis=1) / n
+	down = -np.where(seed < 0, seed, 0.).sum(axis=1) / n
+	res[:, :n] = level(up, down)[:, None]
+
+	if count > n:
+		moves = deltas[:, n-1:]
+		ups = wilder(np.where(moves > 0, moves, 0.), up, n)
+		downs = wilder(np.where(moves > 0, 0., -moves), down, n)
+		res[:, n:] = level(ups, downs)
+		(up, down) = (ups[:, -1], downs[:, -1])
+
+	return (res, up, down)
+
+
 def rsi (closes, n=20):
 	"""
 	compute the n period relative strength indicator
 	http://stockcharts.com/school/doku.php?id=chart_school:glossary_r#relativestrengthindex
 	http://www.investopedia.com/terms/r/rsi.asp
 	"""
+	return smoothed(np.asarray(closes, dtype=np.float64)[None, :], n)[0][0]
 
-	deltas = np.diff(closes)
-	seed = deltas[:n+1]
-	up = seed[seed>=0].sum()/n
-	down = -seed[seed<0].sum()/n
-	rs = up/down
-	rsi = np.zeros_like(closes)
-	rsi[:n] = 100. - 100./(1.+rs)
 
-	for i in range(n, len(closes)):
-		delta = deltas[i-1] # cause the diff is 1 shorter
+def rsi_batch (closes, n=20):
+	"""
+	rsi() for many symbols at once, closes is a (symbols, bars) array with the bars lined up
+	returns an array of the same shape
+	"""
+	return smoothed(np.asarray(closes, dtype=np.float64), n)[0]
 
-		if delta>0:
-			upval = delta
-			downval = 0.
-		else:
-			upval = 0.
-			downval = -delta
 
-		up = (up*(n-1) + upval)/n
-		down = (down*(n-1) + downval)/n
 
-		rs = up/down
-		rsi[i] = 100. - 100./(1.+rs)
+class RsiStream (object):
+	"""
+	incremental rsi(), update(close) returns rsi(closes so far)[-1]
+
+	rsi() seeds its averages from the first n+2 closes, so until there are that many
+	they're kept and the value recomputed.  from there on each update is O(1)
+	"""
+
+	def __init__ (self, n=20):
+		self.n = n
+		self.closes = []
+		self.up = None
+		self.down = None
+		self.value = None
 
-	return rsi
 
+	def update (self, close):
+		close = float(close)
+
+		if self.up is None:
+			self.closes += [close]
+			(res, up, down) = smoothed(np.array([self.closes]), self.n)
+			self.value = res[0, -1]
+			if len(self.closes) == self.n + 2:
+				(self.up, self.down) = (up[0], down[0])
+				self.closes = self.closes[-1:]
+			return self.value
+
+		delta = close - self.closes[-1]
+		self.closes = [close]
+		if delta > 0:
+			(upval, downval) = (delta, 0.)
+		else:
+			(upval, downval) = (0., -delta)
+
+		self.up = (self.up * (self.n - 1) + upval) / self.n
+		self.down = (self.down * (self.n - 1) + downval) / self.n
+		self.value = float(level(self.up, self.down))
+		return self.value
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+from collections import deque
+from itertools import islice
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from decimal import *
 
 D = Decimal
@@ -17,75 +21,218 @@ D = Decimal
 """
 
 
-def sto (quotes, period=10):
-	"""
-	quotes is data as returned from mdcache.get_data()
-	i.e. array of (time, open, close, high, low, volume) tuples
-
-	returns list of (%K, %D) tuples
+class StoStream (object):
 	"""
+	incremental sto(), fed a bar at a time, each update costs amortized O(1)
 
-	if len(quotes) < period:
-		period = len(quotes)
+		s = StoStream()
+		for bar in data:
+			s.update(bar)
+		s.value			# sto(data)[-1]
+		s.peek(spot)		# sto(data + [(t, spot, spot, spot, spot, 0)])[-1], s is left as it was
 
-	res = []
-	lookback = quotes[:period]
-	quotes = quotes[period:]
-
-	max_hi  = D(0)
-	min_low = None
-	sma = []
-
-	# initial values from priming the lookback period
-	for (time, open, close, hi, low, volume) in lookback:
-		if hi > max_hi:
-			max_hi = D(hi)
-		if min_low is None:
-			min_low = D(low)
-		elif low < min_low:
-			min_low = D(low)
+	the lookback high / low are kept in monotonic deques of (index, value): highs
+	non-increasing and lows non-decreasing, the earliest of equal values in front
+	"""
 
-		if max_hi == min_low:
-			# div0
-			continue
-		val = (close - min_low) / (max_hi - min_low) * 100
-		sma += [val]
-		if len(sma) > 3:
-			sma = sma[-3:]
-
-		res += [ (val, sum(sma)/len(sma)) ]
-
-
-	def compute (lookback):
-		max_hi  = D(0)
-		min_low = None
-		last_close = D(0)
-		for (time, open, close, hi, low, volume) in lookback:
-			last_close = close
+	def __init__ (self, period=10):
+		self.period = period
+		# bars in the rolling window once the lookback is primed
+		self.window = max(period, 1)
+		self.count = 0
+
+		# running extremes while priming
+		self.max_hi  = D(0)
+		self.min_low = None
+
+		self.highs = deque()
+		self.lows  = deque()
+		self.sma = deque(maxlen=3)
+
+		# last (%K, %D), None until there is one
+		self.value = None
+
+
+	def front (self, q):
+		"""
+		first deque entry value still inside the window ending at the next bar
+		at most one entry drops out per bar, so only the first two need looking at
+		"""
+		for (i, value) in islice(q, 2):
+			if i > self.count - self.window:
+				return value
+		return None
+
+
+	def compute (self, close, hi, low):
+		"""
+		(%K, lookback high, lookback low) for a bar following those seen so far
+		%K is None for a bar that's skipped while priming
+		"""
+		if self.count < self.period:
+			# initial values from priming the lookback period
+			max_hi = self.max_hi
 			if hi > max_hi:
-				max_hi = hi
+				max_hi = D(hi)
+			min_low = self.min_low
 			if min_low is None:
 				min_low = D(low)
 			elif low < min_low:
 				min_low = D(low)
 
+			if max_hi == min_low:
+				# div0
+				return (None, max_hi, min_low)
+			return ((close - min_low) / (max_hi - min_low) * 100, max_hi, min_low)
+
+		# lookback primed, let's roll
+		top = self.front(self.highs)
+		if top is None or hi > top:
+			top = hi
+		bottom = self.front(self.lows)
+		if bottom is None or low < bottom:
+			bottom = low
+
+		max_hi = D(0)
+		if top > max_hi:
+			max_hi = top
+		min_low = D(bottom)
+
 		if max_hi == min_low:
-			return D(0)
+			return (D(0), max_hi, min_low)
+		return ((close - min_low) / (max_hi - min_low) * 100, max_hi, min_low)
+
+
+	def update (self, bar):
+		"""
+		bar is a (time, open, close, high, low, volume) tuple
+		returns the new (%K, %D), or None if the bar is skipped (see sto())
+		"""
+		(time, open, close, hi, low, volume) = bar
+		(val, max_hi, min_low) = self.compute(close, hi, low)
+
+		i = self.count
+		while self.highs and self.highs[-1][1] < hi:
+			self.highs.pop()
+		self.highs.append((i, hi))
+		while self.lows and self.lows[-1][1] > low:
+			self.lows.pop()
+		self.lows.append((i, low))
+		for q in (self.highs, self.lows):
+			if q[0][0] <= i - self.window:
+				q.popleft()
+
+		self.count += 1
+		if self.count <= self.period:
+			self.max_hi = max_hi
+			self.min_low = min_low
+
+		if val is None:
+			return None
+
+		self.sma.append(val)
+		self.value = (val, sum(self.sma)/len(self.sma))
+		return self.value
+
+
+	def peek (self, spot):
+		"""
+		the (%K, %D) a flat bar at spot would give next, without adding it
+		"""
+		(val, max_hi, min_low) = self.compute(spot, spot, spot)
+		if val is None:
+			return self.value
+
+		sma = list(self.sma)[-2:] + [val]
+		return (val, sum(sma)/len(sma))
+
+
 
-		val = (last_close - min_low) / (max_hi - min_low) * 100
-		return(val)
+def sto (quotes, period=10):
+	"""
+	quotes is data as returned from mdcache.get_data()
+	i.e. array of (time, open, close, high, low, volume) tuples
+
+	returns list of (%K, %D) tuples
 
-	
-	# lookback primed, let's roll
+	the first period bars prime the lookback from the start of the data, one
+	where its high and low are equal is left out; from there on a period bar
+	window rolls.  see StoStream for the incremental version
+	"""
+
+	s = StoStream(period)
+	res = []
 	for q in quotes:
-		lookback = lookback[1:] + [q]
+		val = s.update(q)
+		if val is not None:
+			res += [val]
+	return res
+
 
-		val = compute(lookback)
-		sma += [val]
-		if len(sma) > 3:
-			sma = sma[-3:]
 
-		res += [ (val, sum(sma)/len(sma)) ]
-	
+def align (series, width=None):
+	"""
+	stacks 1d float sequences into a (len(series), width) float64 array for sto_batch()
+	each is right aligned (latest bar in the last column) and padded on the left with NaN
+	width defaults to the longest, longer sequences keep only their last width values
+	"""
+	if width is None:
+		width = max([len(s) for s in series] + [0])
+
+	res = np.empty((len(series), width))
+	res.fill(np.nan)
+	for (i, s) in enumerate(series):
+		s = np.asarray(s, dtype=np.float64)
+		if width and len(s):
+			s = s[-width:]
+			res[i, width - len(s):] = s
 	return res
 
+
+def windows (a, n):
+	"""
+	(symbols, bars, n) view of the n bar windows ending at each bar of a 2d array, nothing copied
+	bars before the first are NaN, so early windows hold what there is
+	"""
+	padded = np.empty((a.shape[0], a.shape[1] + n - 1))
+	padded.fill(np.nan)
+	padded[:, n - 1:] = a
+	(s0, s1) = padded.strides
+	return as_strided(padded, shape=(a.shape[0], a.shape[1], n), strides=(s0, s1, s1))
+
+
+def sto_batch (closes, highs, lows, periods=(10,)):
+	"""
+	sto() for many symbols in one pass, float64 arrays shaped (symbols, bars)
+	bars line up by column, NaN for a missing bar (see align() for ragged histories)
+
+	returns a dict of period -> (%K, %D) arrays shaped like closes
+
+	as in sto() the lookback high is floored at 0 and, until a period of bars has
+	been seen, covers those there are.  a window whose high and low are equal gives
+	a %K of 0 (sto() leaves those out while priming).  %D is the mean of the %Ks of
+	the last 3 bars
+	"""
+	closes = np.asarray(closes, dtype=np.float64)
+	highs = np.asarray(highs, dtype=np.float64)
+	lows = np.asarray(lows, dtype=np.float64)
+
+	res = {}
+	for period in periods:
+		n = max(period, 1)
+		# fmax / fmin skip NaN, so the padding and missing bars drop out
+		max_hi = np.fmax(np.fmax.reduce(windows(highs, n), axis=2), 0.)
+		min_low = np.fmin.reduce(windows(lows, n), axis=2)
+		span = max_hi - min_low
+
+		with np.errstate(divide='ignore', invalid='ignore'):
+			k = (closes - min_low) / span * 100
+			k[span == 0] = 0.
+			k[np.isnan(closes)] = np.nan
+
+			last3 = windows(k, 3)
+			valid = ~np.isnan(last3)
+			d = np.where(valid, last3, 0.).sum(axis=2) / valid.sum(axis=2)
+
+		res[period] = (k, d)
+	return res
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+mdcache range tracking: only the uncovered parts of a request go to the provider,
+and what comes back is merged into the store in date order
+
+	python -m unittest test_mdcache
+"""
+
+import os, shutil, tempfile, datetime, threading, unittest
+import numpy as np
+import matplotlib.dates as dates
+import mdcache, mdstore, provider, tradecal
+
+
+class FakeProvider (provider.Provider):
+	"""
+	a bar for every session, recording the (from, to) dates of each history request
+	no bars at all from the first day of halted (a (from, to) pair) to the second
+	"""
+
+	def __init__ (self):
+		self.requests = []
+		self.halted = None
+
+
+	def history (self, symbol, date_from, date_to):
+		self.requests += [(date_from.date(), date_to.date())]
+		return bars(date_from.date(), date_to.date(), self.halted)
+
+
+def bars (date_from, date_to, halted=None):
+	rows = []
+	for n in range(date_from.toordinal(), date_to.toordinal() + 1):
+		day = datetime.date.fromordinal(n)
+		if halted and halted[0] <= day <= halted[1]:
+			continue
+		if tradecal.has_session(day, day):
+			p = 10 + (n % 17) * .37
+			rows += [(dates.date2num(day), p, p + .1, p + .5, p - .5, 1000 + n % 7)]
+	return rows
+
+
+day = datetime.date
+
+
+class RangeTests (object):
+	"""
+	mixed into a TestCase per store backend
+	"""
+	kind = None
+
+	def setUp (self):
+		self.saved = (mdcache.cachedir, mdcache.failfile, mdstore.backend)
+		mdcache.cachedir = tempfile.mkdtemp()
+		mdcache.failfile = os.path.join(mdcache.cachedir, '.failures')
+		mdstore.backend = self.kind
+		mdcache.forget()
+		self.provider = FakeProvider()
+		self.prev_provider = provider.use(self.provider)
+
+
+	def tearDown (self):
+		provider.use(self.prev_provider)
+		if self.kind == 'sqlite':
+			mdstore.SqliteStore.connections.pop(os.path.join(mdcache.cachedir, mdstore.sqlite_name)).close()
+		shutil.rmtree(mdcache.cachedir)
+		(mdcache.cachedir, mdcache.failfile, mdstore.backend) = self.saved
+		mdcache.forget()
+
+
+	def load (self, date_from, date_to):
+		"""
+		loads date_from..date_to afresh (not from the in-process history cache)
+		returns the provider requests it made
+		"""
+		mdcache.forget()
+		del self.provider.requests[:]
+		m = mdcache.mdcache('abc', date_from=date_from, date_to=date_to)
+
+		cols = m.get_columns()
+		expected = mdstore.to_columns(bars(date_from, date_to, self.provider.halted))
+		for name in mdstore.columns:
+			self.assertTrue(np.array_equal(cols[name], expected[name]), name)
+
+		return self.provider.requests
+
+
+	def stored (self):
+		(meta, cols) = mdstore.store(mdcache.cachedir, 'abc').load()
+		self.assertTrue(np.all(np.diff(cols['date']) > 0))
+		self.assertEqual(meta['rows'], len(cols['date']))
+		return meta['ranges']
+
+
+	def test_covered (self):
+		self.assertEqual(self.load(day(2014, 3, 3), day(2014, 6, 2)), [(day(2014, 3, 3), day(2014, 6, 2))])
+		self.assertEqual(self.load(day(2014, 3, 3), day(2014, 6, 2)), [])
+		self.assertEqual(self.load(day(2014, 4, 1), day(2014, 5, 1)), [])
+
+
+	def test_late (self):
+		self.load(day(2014, 3, 3), day(2014, 6, 2))
+		self.assertEqual(self.load(day(2014, 3, 3), day(2014, 9, 2)), [(day(2014, 6, 3), day(2014, 9, 2))])
+		self.assertEqual(self.stored(), [[dates.date2num(day(2014, 3, 3)), dates.date2num(day(2014, 9, 2))]])
+
+
+	def test_late_empty (self):
+		# a range in the past with no bars for it is still recorded as fetched
+		self.load(day(2014, 3, 3), day(2014, 6, 2))
+		self.provider.halted = (day(2014, 6, 3), day(2014, 6, 13))
+		self.assertEqual(self.load(day(2014, 3, 3), day(2014, 6, 13)), [(day(2014, 6, 3), day(2014, 6, 13))])
+		self.assertEqual(self.stored(), [[dates.date2num(day(2014, 3, 3)), dates.date2num(day(2014, 6, 13))]])
+		self.assertEqual(self.load(day(2014, 3, 3), day(2014, 6, 13)), [])
+
+
+	def test_early (self):
+		self.load(day(2014, 3, 3), day(2014, 6, 2))
+		self.assertEqual(self.load(day(2014, 1, 2), day(2014, 6, 2)), [(day(2014, 1, 2), day(2014, 3, 2))])
+		self.assertEqual(self.stored(), [[dates.date2num(day(2014, 1, 2)), dates.date2num(day(2014, 6, 2))]])
+
+
+	def test_gap (self):
+		self.load(day(2014, 1, 2), day(2014, 3, 3))
+		self.load(day(2014, 6, 2), day(2014, 9, 2))
+		self.assertEqual(len(self.stored()), 2)
+		self.assertEqual(self.load(day(2013, 12, 2), day(2014, 10, 1)), [
+				(day(2013, 12, 2), day(2014, 1, 1)),
+				(day(2014, 3, 4), day(2014, 6, 1)),
+				(day(2014, 9, 3), day(2014, 10, 1)),
+			])
+		self.assertEqual(self.stored(), [[dates.date2num(day(2013, 12, 2)), dates.date2num(day(2014, 10, 1))]])
+
+
+	def test_legacy_meta (self):
+		# written before range tracking, with date_high a day whose bar never came
+		meta = {'date_low': dates.date2num(day(2014, 3, 3)), 'date_high': dates.date2num(day(2014, 6, 6))}
+		mdstore.store(mdcache.cachedir, 'abc').write(meta, mdstore.to_columns(bars(day(2014, 3, 3), day(2014, 6, 5))))
+		self.assertEqual(self.load(day(2014, 3, 3), day(2014, 6, 6)), [(day(2014, 6, 6), day(2014, 6, 6))])
+		self.assertEqual(self.stored(), [[dates.date2num(day(2014, 3, 3)), dates.date2num(day(2014, 6, 6))]])
+		self.assertEqual(self.load(day(2014, 3, 3), day(2014, 6, 6)), [])
+
+
+	def test_weekend_gap (self):
+		# friday, then the week after: the weekend between needs no fetch
+		self.load(day(2014, 6, 2), day(2014, 6, 6))
+		self.load(day(2014, 6, 9), day(2014, 6, 13))
+		self.assertEqual(len(self.stored()), 1)
+		self.assertEqual(self.load(day(2014, 6, 2), day(2014, 6, 13)), [])
+
+
+
+class ColumnRangeTests (RangeTests, unittest.TestCase):
+	kind = 'columns'
+
+
+class SqliteRangeTests (RangeTests, unittest.TestCase):
+	kind = 'sqlite'
+
+
+
+class FailureTests (unittest.TestCase):
+
+	def setUp (self):
+		self.saved = mdcache.failfile
+		self.root = tempfile.mkdtemp()
+		mdcache.failfile = os.path.join(self.root, '.failures')
+
+
+	def tearDown (self):
+		shutil.rmtree(self.root)
+		mdcache.failfile = self.saved
+
+
+	def test_concurrent (self):
+		errors = []
+		def write ():
+			try:
+				for i in range(50):
+					mdcache._write_failures()
+			except Exception, e:
+				errors.append(e)
+
+		# as from other processes, each with its own failures_lock
+		threads = [threading.Thread(target=write) for i in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(errors, [])
+		self.assertEqual(os.listdir(self.root), ['.failures'])
+
+
+	def test_unwritable (self):
+		mdcache.failfile = os.path.join(self.root, 'missing', '.failures')
+		mdcache.record_failure('abc')
+		self.assertEqual(mdcache.retry_after('abc'), None)
+
+
+
+class RangeMathTests (unittest.TestCase):
+
+	def test_uncovered (self):
+		ranges = [[10, 20], [30, 40]]
+		self.assertEqual(mdcache.uncovered(ranges, 0, 50), [[0, 9], [21, 29], [41, 50]])
+		self.assertEqual(mdcache.uncovered(ranges, 12, 35), [[21, 29]])
+		self.assertEqual(mdcache.uncovered(ranges, 12, 18), [])
+		self.assertEqual(mdcache.uncovered([], 1, 2), [[1, 2]])
+
+
+	def test_covered (self):
+		self.assertEqual(mdcache.covered({}), [])
+		# legacy metas end at the last bar stored, not date_high
+		self.assertEqual(mdcache.covered({'date_low': 1, 'date_high': 5}, 4), [[1, 4]])
+		self.assertEqual(mdcache.covered({'date_low': 1, 'date_high': 5}), [])
+		self.assertEqual(mdcache.covered({'ranges': [[1, 5], [8, 9]], 'date_low': 1, 'date_high': 9}), [[1, 5], [8, 9]])
+
+
+	def test_add_range (self):
+		monday = dates.date2num(day(2014, 6, 2))
+		# overlapping and touching ranges merge, separate ones don't
+		self.assertEqual(mdcache.add_range([[monday, monday + 2]], monday + 1, monday + 3), [[monday, monday + 3]])
+		self.assertEqual(mdcache.add_range([[monday, monday + 2]], monday + 3, monday + 3), [[monday, monday + 3]])
+		self.assertEqual(mdcache.add_range([[monday, monday + 1]], monday + 3, monday + 3), [[monday, monday + 1], [monday + 3, monday + 3]])
+		# as do ranges with only a weekend between them
+		self.assertEqual(mdcache.add_range([[monday, monday + 4]], monday + 7, monday + 8), [[monday, monday + 8]])
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+round trips through the mdcache storage backends
+
+	python -m unittest test_mdstore
+"""
+
+import os, shutil, tempfile, threading, unittest
+import numpy as np
+import mdstore
+
+
+def bars (first, last):
+	"""
+	column dict of made up bars dated first..last-1
+	"""
+	return mdstore.to_columns([(float(d), d + .1, d + .2, d + .3, d + .4, d * 10.) for d in range(first, last)])
+
+
+class StoreTests (object):
+	"""
+	checks both backends must pass, mixed into a TestCase per backend
+	"""
+	kind = None
+
+	def setUp (self):
+		self.root = tempfile.mkdtemp()
+		self.store = mdstore.store(self.root, 'abc', self.kind)
+
+
+	def tearDown (self):
+		if self.kind == 'sqlite':
+			mdstore.SqliteStore.connections.pop(os.path.join(self.root, mdstore.sqlite_name)).close()
+		shutil.rmtree(self.root)
+
+
+	def assertBars (self, cols, first, last):
+		expected = bars(first, last)
+		for name in mdstore.columns:
+			self.assertEqual(list(cols[name]), list(expected[name]), name)
+
+
+	def test_write_load (self):
+		self.store.write({'ranges': [[0, 9]]}, bars(0, 10))
+		self.assertTrue(self.store.exists())
+		(meta, cols) = self.store.load()
+		self.assertEqual(meta['rows'], 10)
+		self.assertEqual(meta['ranges'], [[0, 9]])
+		self.assertBars(cols, 0, 10)
+
+
+	def test_append (self):
+		self.store.write({}, bars(0, 10))
+		(meta, cols) = self.store.load()
+		self.store.append(meta, bars(10, 15))
+		self.store.append(meta, bars(15, 15))
+		(meta, cols) = self.store.load()
+		self.assertEqual(meta['rows'], 15)
+		self.assertBars(cols, 0, 15)
+
+
+	def test_stale_append (self):
+		self.store.write({}, bars(0, 10))
+		(meta, cols) = self.store.load()
+		self.store.append(meta, bars(10, 15))
+		# a second writer that read the meta before the first appended
+		self.store.append(meta, bars(10, 16))
+		(meta, cols) = self.store.load()
+		self.assertEqual(meta['rows'], 16)
+		self.assertBars(cols, 0, 16)
+
+
+	def test_ranged_load (self):
+		self.store.write({}, bars(0, 20))
+		(meta, cols) = self.store.load(5, 9)
+		self.assertBars(cols, 5, 10)
+		(meta, cols) = self.store.load(date_to=3)
+		self.assertBars(cols, 0, 4)
+		self.assertEqual(meta['rows'], 20)
+
+
+	def test_merge (self):
+		self.store.write({}, bars(10, 20))
+		(meta, cols) = self.store.load()
+		# early rows, a gap fill and rows that are already stored (which win)
+		new = mdstore.concat(bars(0, 5), bars(8, 12))
+		new['close'] = new['close'] + 100
+		self.store.merge(meta, new)
+		(meta, cols) = self.store.load()
+		self.assertEqual(meta['rows'], 17)
+		self.assertEqual(list(cols['date']), range(0, 5) + range(8, 20))
+		self.assertEqual(list(cols['close'][:7]), list(new['close'][:7]))
+		self.assertEqual(list(cols['close'][7:]), list(bars(10, 20)['close']))
+
+
+	def test_remove (self):
+		self.store.write({}, bars(0, 3))
+		self.store.remove()
+		self.assertFalse(self.store.exists())
+
+
+
+class ColumnStoreTests (StoreTests, unittest.TestCase):
+	kind = 'columns'
+
+	def column_file (self, name):
+		return os.path.join(self.store.path, name)
+
+
+	def test_mapped (self):
+		self.store.write({}, bars(0, 10))
+		(meta, cols) = self.store.load()
+		self.assertTrue(isinstance(cols['close'], np.memmap))
+		(meta, cols) = self.store.load(2, 5)
+		self.assertTrue(isinstance(cols['close'], np.memmap))
+
+
+	def test_torn_append (self):
+		self.store.write({}, bars(0, 10))
+		# an append that died before the meta was written
+		for name in mdstore.columns:
+			f = open(self.column_file(name), 'ab')
+			f.write('\0' * 12)
+			f.close()
+		(meta, cols) = self.store.load()
+		self.assertBars(cols, 0, 10)
+
+		self.store.append(meta, bars(10, 12))
+		(meta, cols) = self.store.load()
+		self.assertBars(cols, 0, 12)
+		self.assertEqual(os.path.getsize(self.column_file('date')), 12 * mdstore.dtype.itemsize)
+
+
+	def test_concurrent_append (self):
+		self.store.write({}, bars(0, 10))
+		(meta, cols) = self.store.load()
+		threads = [threading.Thread(target=self.store.append, args=(meta, bars(10, 20))) for i in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		(meta, cols) = self.store.load()
+		self.assertBars(cols, 0, 20)
+
+
+	def test_migrate_json (self):
+		f = open(self.store.path, 'w')
+		f.write('{"date_low": 0, "date_high": 4, "hloc": [[0, 1, 2, 3, 4, 5], [1, 1, 2, 3, 4, 5]]}')
+		f.close()
+		self.assertTrue(self.store.exists())
+		(meta, cols) = self.store.load()
+		self.assertEqual(list(cols['date']), [0., 1.])
+		self.assertEqual(list(cols['volume']), [5., 5.])
+
+
+
+class SqliteStoreTests (StoreTests, unittest.TestCase):
+	kind = 'sqlite'
+
+	def test_universe (self):
+		self.store.write({}, bars(0, 10))
+		mdstore.store(self.root, 'xyz', self.kind).write({}, bars(5, 8))
+		universe = mdstore.load_universe(self.root, 6, 20, kind=self.kind)
+		self.assertEqual(sorted(universe), ['ABC', 'XYZ'])
+		self.assertBars(universe['ABC'], 6, 10)
+		self.assertBars(universe['XYZ'], 6, 8)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+pnf graphs carried forward from saved state must match graphs built from scratch,
+and render as they did before render_grid()
+
+	python -m unittest test_pnf
+"""
+
+import re, shutil, tempfile, random, datetime, unittest
+import matplotlib.dates as dates
+import mdcache, mdstore, pnf
+
+
+def walk (seed, count, start=20., vol=.02):
+	"""
+	column dict of count made up weekday bars from 2000-01-03 on, a random walk from start
+	that doesn't go under a twentieth of start
+	"""
+	r = random.Random(seed)
+	day = datetime.date(2000, 1, 3)
+	price = start
+	rows = []
+	while len(rows) < count:
+		if day.weekday() < 5:
+			prev = price
+			price = max(start / 20, price * (1 + r.gauss(0, vol)))
+			high = max(prev, price) * (1 + abs(r.gauss(0, vol / 3)))
+			low = min(prev, price) * (1 - abs(r.gauss(0, vol / 3)))
+			rows += [(dates.date2num(day), prev, price, high, low, 1000)]
+		day += datetime.timedelta(days=1)
+	return mdstore.to_columns(rows)
+
+
+class FakeHistory (object):
+	"""
+	stands in for mdcache.mdcache, serving rows first..last-1 of cols
+	"""
+	cols = None
+	first = 0
+	last = 0
+
+	def __init__ (self, symbol):
+		pass
+
+
+	def get_data (self):
+		return mdcache.DecimalView(self.cols, self.first, self.last)
+
+
+
+def dump (g):
+	"""
+	everything that makes up a graph, comparable with ==
+	"""
+	cols = [(c.marker, c.high, c.low, c.uptrend, c.downtrend, c.months, c.start_date) for c in g.columns]
+	return (list(g.boxes), cols, g.get_reversal(), g.get_continuation())
+
+
+
+def old_output (g, style=''):
+	"""
+	Graph.get_output() as it was before render_grid(), plain and ansi styles
+	"""
+	spot = g.last_close
+	last_marker = g.columns[-1].marker
+	going_down = (last_marker == 'X' and spot < g.columns[-1].high) or (last_marker == 'O' and spot <= g.columns[-1].low)
+	spot_box = g.fit_value(spot, descending=going_down)
+	output = g.explain() + "\n\t\t" + ' ' * (len(g.columns)/2 - len(g.sym)/2) + "%s" % g.sym.upper() + "\n"
+
+	for box in reversed(g.boxes):
+		label = g.scale.label(box)
+		row = "%s\t\t" % label
+		for col in g.columns:
+			if box == col.downtrend:
+				row += "\033[31m+\033[0m" if style == 'ansi' else "+"
+				continue
+			if box == col.uptrend:
+				row += "\033[34m+\033[0m" if style == 'ansi' else "+"
+				continue
+			months = [mon for (mon, mon_box) in col.months if mon_box == box]
+			if months:
+				row += "\033[7m\033[1m%s\033[0m" % months[0] if style == 'ansi' else months[0]
+				continue
+			if col.high >= box and col.low <= box:
+				row += col.marker
+			else:
+				row += ' '
+
+		if box == spot_box and style == 'ansi':
+			row += "\t\033[31m\033[1m%s\033[0m" % label
+		else:
+			row += "\t%s" % label
+		output += "%s\n" % row
+
+	return output
+
+
+def plain (output):
+	"""
+	output with the ansi colour codes taken out
+	"""
+	return re.sub('\033\\[[0-9;]*m', '', output)
+
+
+
+class GraphCase (unittest.TestCase):
+	"""
+	pnf.Graph over FakeHistory, with its saved state in a scratch dir
+	"""
+
+	def setUp (self):
+		self.saved = (pnf.statedir, pnf.mdcache.mdcache)
+		pnf.statedir = tempfile.mkdtemp()
+		pnf.mdcache.mdcache = FakeHistory
+
+
+	def tearDown (self):
+		shutil.rmtree(pnf.statedir)
+		(pnf.statedir, pnf.mdcache.mdcache) = self.saved
+
+
+	def graph (self, first, last, cached=True, scale=None):
+		FakeHistory.first = first
+		FakeHistory.last = last
+		return pnf.Graph('TST', cached=cached, scale=scale)
+
+
+
+class RestoreTests (GraphCase):
+
+	def test_refresh (self):
+		"""
+		a window growing and sliding a few bars at a time
+		"""
+		for seed in range(3):
+			FakeHistory.cols = walk(seed, 700)
+			origin = 100
+			self.assertEqual(dump(self.graph(origin, 400)), dump(self.graph(origin, 400, cached=False)))
+
+			for step in range(1, 20):
+				(first, last) = (100 + step * 3, 400 + step * 3)
+				g = self.graph(first, last)
+
+				window_start = FakeHistory.cols['date'][first]
+				self.assertTrue(0 <= window_start - g.origin <= pnf.rebase_days)
+				if g.origin != FakeHistory.cols['date'][origin]:
+					# rebased onto the window
+					self.assertEqual(g.origin, window_start)
+					origin = first
+
+				self.assertEqual(dump(g), dump(self.graph(origin, last, cached=False)), (seed, step))
+
+
+	def test_nothing_new (self):
+		FakeHistory.cols = walk(1, 300)
+		self.graph(0, 300)
+		self.assertEqual(dump(self.graph(0, 300)), dump(self.graph(0, 300, cached=False)))
+		self.assertEqual(dump(self.graph(5, 300)), dump(self.graph(0, 300, cached=False)))
+
+
+	def test_revised (self):
+		"""
+		a saved graph whose last bar has changed since is rebuilt
+		"""
+		FakeHistory.cols = walk(2, 300)
+		self.graph(0, 200)
+		FakeHistory.cols['close'][199] += .5
+		g = self.graph(10, 210)
+		self.assertEqual(g.origin, FakeHistory.cols['date'][10])
+		self.assertEqual(dump(g), dump(self.graph(10, 210, cached=False)))
+
+
+	def test_other_scale (self):
+		FakeHistory.cols = walk(3, 300)
+		self.graph(0, 200)
+		g = self.graph(0, 210, scale=pnf.FixedScale())
+		self.assertEqual(dump(g), dump(self.graph(0, 210, cached=False, scale=pnf.FixedScale())))
+
+
+	def test_bad_state (self):
+		FakeHistory.cols = walk(4, 300)
+		g = self.graph(0, 200)
+		f = open(g.state_file(), 'w')
+		f.write('{"version": 1, "colu')
+		f.close()
+		self.assertEqual(dump(self.graph(0, 210)), dump(self.graph(0, 210, cached=False)))
+
+
+
+class RenderTests (GraphCase):
+
+	def check (self, g):
+		text = g.get_output()
+		self.assertEqual(text, old_output(g))
+		colour = g.get_output(style='ansi')
+		self.assertNotEqual(colour, text)
+		self.assertEqual(plain(colour), text)
+		self.assertEqual(plain(old_output(g, style='ansi')), text)
+		return text
+
+
+	def test_old (self):
+		for seed in range(3):
+			FakeHistory.cols = walk(seed, 400)
+			self.check(self.graph(0, 400))
+
+
+	def test_sub_cent (self):
+		# boxes under a cent tall get longer labels
+		FakeHistory.cols = walk(5, 300, start=.8)
+		text = self.check(self.graph(0, 300))
+		self.assertTrue(re.search(r'^ *0\.\d{3,}\t', text, re.M))
+
+
+	def test_columns (self):
+		FakeHistory.cols = walk(6, 400)
+		g = self.graph(0, 400)
+		full = g.get_output().split('\n')
+		last = g.get_output(columns=5).split('\n')
+		# the rows shown, cut down to their last 5 columns
+		body = dict([(line.split('\t')[0], line.split('\t')[2][-5:]) for line in full if line.count('\t') == 3])
+		rows = [line for line in last if line.count('\t') == 3]
+		self.assertTrue(0 < len(rows) < len(body))
+		for line in rows:
+			self.assertEqual(line.split('\t')[2], body[line.split('\t')[0]])
+
+
+
+class BoxGridTests (unittest.TestCase):
+
+	def test_list (self):
+		"""
+		a grid grown at both ends reads the same as a plain list
+		"""
+		r = random.Random(5)
+		grid = pnf.BoxGrid()
+		boxes = []
+		for i in range(300):
+			if boxes and r.random() < .4:
+				values = [boxes[0] - k for k in range(r.randint(1, 4), 0, -1)]
+				grid.prepend(values)
+				boxes[:0] = values
+			else:
+				value = boxes[-1] + 1 if boxes else 0
+				grid.append(value)
+				boxes += [value]
+
+			self.assertEqual(len(grid), len(boxes))
+			self.assertEqual(list(grid), boxes)
+			self.assertEqual(list(reversed(grid)), boxes[::-1])
+			self.assertEqual((grid[0], grid[-1], grid[len(boxes) // 2]), (boxes[0], boxes[-1], boxes[len(boxes) // 2]))
+			self.assertEqual(grid[1:-1:2], boxes[1:-1:2])
+			for value in (boxes[0], boxes[-1], r.choice(boxes)):
+				self.assertTrue(value in grid)
+				self.assertEqual(grid.index(value), boxes.index(value))
+
+		self.assertFalse(boxes[-1] + 1 in grid)
+		self.assertRaises(ValueError, grid.index, boxes[-1] + 1)
+		self.assertRaises(IndexError, grid.__getitem__, len(boxes))
+
+
+
+class ScaleTests (unittest.TestCase):
+
+	def test_index (self):
+		for scale in (pnf.LogScale(), pnf.FixedScale()):
+			boxes = [scale.value(row) for row in range(-300, 700)]
+			self.assertEqual(boxes, sorted(set(boxes)))
+			for value in ['0.0013', '0.05', '1', '4.99', '5', '99.99', '100', '12345.67']:
+				row = scale.index(pnf.D(value))
+				self.assertTrue(scale.value(row) <= pnf.D(value) < scale.value(row + 1), (scale, value))
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+rsi against the plain loop it replaced
+
+	python -m unittest test_rsi
+"""
+
+import random, unittest
+import numpy as np
+import rsi
+
+
+def loop (closes, n=20):
+	"""
+	the original per bar rsi, with no down moves it divides by zero on the way to 100
+	"""
+	with np.errstate(divide='ignore'):
+		return _loop(closes, n)
+
+
+def _loop (closes, n):
+	deltas = np.diff(closes)
+	seed = deltas[:n+1]
+	up = seed[seed>=0].sum()/n
+	down = -seed[seed<0].sum()/n
+	res = np.zeros_like(closes)
+	res[:n] = 100. - 100./(1.+up/down)
+
+	for i in range(n, len(closes)):
+		delta = deltas[i-1]
+		if delta>0:
+			(upval, downval) = (delta, 0.)
+		else:
+			(upval, downval) = (0., -delta)
+		up = (up*(n-1) + upval)/n
+		down = (down*(n-1) + downval)/n
+		res[i] = 100. - 100./(1.+up/down)
+
+	return res
+
+
+def walk (seed, count):
+	r = random.Random(seed)
+	closes = [50.]
+	while len(closes) < count:
+		closes += [max(1., closes[-1] * (1 + r.gauss(0, .02)))]
+	return np.array(closes)
+
+
+
+class RsiTests (unittest.TestCase):
+
+	def test_loop (self):
+		# lengths either side of the seed and of the closed form's block
+		for count in (23, 24, 100, rsi.block + 21, rsi.block + 22, 3 * rsi.block + 5, 5000):
+			for n in (2, 14, 20):
+				closes = walk(count + n, count)
+				self.assertTrue(np.allclose(rsi.rsi(closes, n), loop(closes, n), rtol=0, atol=1e-13), (count, n))
+
+
+	def test_batch (self):
+		closes = np.array([walk(seed, 600) for seed in range(5)])
+		res = rsi.rsi_batch(closes, 14)
+		for (row, expected) in zip(res, closes):
+			self.assertTrue(np.allclose(row, loop(expected, 14), rtol=0, atol=1e-13))
+
+
+	def test_stream (self):
+		closes = walk(7, 200)
+		stream = rsi.RsiStream(14)
+		for i in range(len(closes)):
+			self.assertAlmostEqual(stream.update(closes[i]), rsi.rsi(closes[:i + 1], 14)[-1], places=12)
+
+
+	def test_no_moves (self):
+		self.assertEqual(list(rsi.rsi(np.arange(30.), 5)[-3:]), [100.] * 3)
+		self.assertEqual(list(rsi.rsi(np.ones(30), 5)[-3:]), [50.] * 3)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+sto against the loop it replaced, and sto_batch against sto
+
+	python -m unittest test_sto
+"""
+
+import random, unittest
+import numpy as np
+import sto
+from decimal import *
+
+D = Decimal
+
+
+def loop (quotes, period=10):
+	"""
+	the original sto, re-scanning the whole lookback for every bar
+	"""
+	if len(quotes) < period:
+		period = len(quotes)
+
+	res = []
+	lookback = quotes[:period]
+	quotes = quotes[period:]
+
+	max_hi  = D(0)
+	min_low = None
+	sma = []
+
+	for (time, open, close, hi, low, volume) in lookback:
+		if hi > max_hi:
+			max_hi = D(hi)
+		if min_low is None:
+			min_low = D(low)
+		elif low < min_low:
+			min_low = D(low)
+
+		if max_hi == min_low:
+			continue
+		val = (close - min_low) / (max_hi - min_low) * 100
+		sma += [val]
+		if len(sma) > 3:
+			sma = sma[-3:]
+
+		res += [ (val, sum(sma)/len(sma)) ]
+
+	def compute (lookback):
+		max_hi  = D(0)
+		min_low = None
+		last_close = D(0)
+		for (time, open, close, hi, low, volume) in lookback:
+			last_close = close
+			if hi > max_hi:
+				max_hi = hi
+			if min_low is None:
+				min_low = D(low)
+			elif low < min_low:
+				min_low = D(low)
+
+		if max_hi == min_low:
+			return D(0)
+		return (last_close - min_low) / (max_hi - min_low) * 100
+
+	for q in quotes:
+		lookback = lookback[1:] + [q]
+		val = compute(lookback)
+		sma += [val]
+		if len(sma) > 3:
+			sma = sma[-3:]
+		res += [ (val, sum(sma)/len(sma)) ]
+
+	return res
+
+
+def walk (seed, count, flat=0.):
+	"""
+	count made up bars of 2 place Decimal prices, a random walk
+	a flat fraction of them have open, close, high and low all equal
+	"""
+	r = random.Random(seed)
+	price = D('20.00')
+	res = []
+	for t in range(count):
+		prev = price
+		price = max(D('1.00'), (price * D(1 + r.gauss(0, .03))).quantize(D('0.01')))
+		if r.random() < flat:
+			res += [(t, price, price, price, price, 100)]
+			continue
+		hi = max(prev, price) + D(r.randint(1, 30)) / 100
+		low = min(prev, price) - D(r.randint(1, 30)) / 100
+		res += [(t, prev, price, hi, low, 100)]
+	return res
+
+
+
+class StoTests (unittest.TestCase):
+
+	def test_loop (self):
+		for seed in range(6):
+			for count in (0, 1, 2, 5, 9, 10, 11, 12, 80):
+				for period in (1, 3, 10, 14):
+					quotes = walk(seed, count, flat=seed / 10.)
+					self.assertEqual(sto.sto(quotes, period), loop(quotes, period), (seed, count, period))
+
+
+	def test_all_flat (self):
+		quotes = [(t, D(5), D(5), D(5), D(5), 0) for t in range(15)]
+		self.assertEqual(sto.sto(quotes), loop(quotes))
+
+
+	def test_stream (self):
+		quotes = walk(7, 60, flat=.2)
+		s = sto.StoStream(10)
+		for i in range(len(quotes)):
+			spot = quotes[i][2]
+			self.assertEqual(s.peek(spot), (loop(quotes[:i] + [(i, spot, spot, spot, spot, 0)]) or [None])[-1], i)
+			s.update(quotes[i])
+			self.assertEqual(s.value, (loop(quotes[:i + 1]) or [None])[-1], i)
+
+
+
+class BatchTests (unittest.TestCase):
+
+	def columns (self, histories):
+		return [sto.align([[float(q[n]) for q in quotes] for quotes in histories]) for n in (2, 3, 4)]
+
+
+	def test_sto (self):
+		# some shorter than the window, sto_batch drops their padding from it
+		histories = [walk(seed, count) for (seed, count) in enumerate((1, 2, 3, 5, 9, 10, 11, 12, 40))]
+		(closes, highs, lows) = self.columns(histories)
+		res = sto.sto_batch(closes, highs, lows, periods=(3, 10))
+
+		for period in (3, 10):
+			(k, d) = res[period]
+			for (i, quotes) in enumerate(histories):
+				(val, sma) = sto.sto(quotes, period)[-1]
+				self.assertAlmostEqual(k[i, -1], float(val), places=9)
+				self.assertAlmostEqual(d[i, -1], float(sma), places=9)
+
+
+	def test_missing (self):
+		# a NaN bar drops out of the windows holding it
+		quotes = walk(3, 20)
+		(closes, highs, lows) = self.columns([quotes])
+		for a in (closes, highs, lows):
+			a[0, 15] = np.nan
+		(k, d) = sto.sto_batch(closes, highs, lows)[10]
+
+		window = quotes[10:15] + quotes[16:]
+		hi = float(max([q[3] for q in window]))
+		low = float(min([q[4] for q in window]))
+		self.assertAlmostEqual(k[0, -1], (float(quotes[-1][2]) - low) / (hi - low) * 100, places=9)
+		self.assertTrue(np.isnan(k[0, 15]))
+
+
+	def test_align (self):
+		a = sto.align([[1., 2., 3.], [4.], []], 2)
+		self.assertEqual(a[0].tolist(), [2., 3.])
+		self.assertTrue(np.isnan(a[1, 0]) and a[1, 1] == 4.)
+		self.assertTrue(np.isnan(a[2]).all())
+		self.assertEqual(sto.align([[1.], [1., 2.]]).shape, (2, 2))
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+NYSE trading calendar
+
+answers whether a day is a trading session, and what the most recent session
+with a published daily bar is.  holidays are computed from the exchange's rules
+rather than looked up, so there is no table to keep current (beyond one-off closures)
+
+>>> is_session(datetime.date(2012, 4, 6))	# good friday
+False
+>>> is_session(datetime.date(2010, 12, 31))	# new year's on a saturday isn't observed
+True
+>>> previous_session(datetime.date(2015, 7, 6))
+datetime.date(2015, 7, 2)
+>>> last_session(datetime.datetime(2015, 7, 2, 19, 0))	# 3pm EDT, before the close
+datetime.date(2015, 7, 1)
+>>> last_session(datetime.datetime(2015, 7, 2, 21, 0))
+datetime.date(2015, 7, 2)
+"""
+
+import datetime
+
+
+# regular session close, US/Eastern
+session_close = datetime.time(16, 0)
+
+# how long after the close the day's bar shows up in the history feed
+publish_delay = datetime.timedelta(minutes=30)
+
+# unscheduled full day closures
+closures = set([
+		datetime.date(2001, 9, 11),
+		datetime.date(2001, 9, 12),
+		datetime.date(2001, 9, 13),
+		datetime.date(2001, 9, 14),
+		datetime.date(2004, 6, 11),		# reagan
+		datetime.date(2007, 1, 2),		# ford
+		datetime.date(2012, 10, 29),	# sandy
+		datetime.date(2012, 10, 30),
+		datetime.date(2018, 12, 5),		# bush
+		datetime.date(2025, 1, 9),		# carter
+	])
+
+_holidays = {}
+
+
+def nth_weekday (year, month, weekday, n):
+	"""
+	date of the nth (1 based) given weekday (mon=0) of the month
+	n=-1 gives the last one
+	"""
+	if n > 0:
+		first = datetime.date(year, month, 1)
+		return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+
+	if month == 12:
+		last = datetime.date(year, 12, 31)
+	else:
+		last = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
+	return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def easter (year):
+	"""
+	gregorian easter sunday (anonymous gregorian algorithm)
+	"""
+	a = year % 19
+	b = year / 100
+	c = year % 100
+	d = b / 4
+	e = b % 4
+	f = (b + 8) / 25
+	g = (b - f + 1) / 3
+	h = (19 * a + b - d - g + 15) % 30
+	i = c / 4
+	k = c % 4
+	l = (32 + 2 * e + 2 * i - h - k) % 7
+	m = (a + 11 * h + 22 * l) / 451
+	month = (h + l - 7 * m + 114) / 31
+	day = (h + l - 7 * m + 114) % 31 + 1
+	return datetime.date(year, month, day)
+
+
+def observed (day):
+	"""
+	fixed date holidays falling on a weekend are observed on the nearest weekday
+	"""
+	if day.weekday() == 5:
+		return day - datetime.timedelta(days=1)
+	if day.weekday() == 6:
+		return day + datetime.timedelta(days=1)
+	return day
+
+
+def holidays (year):
+	"""
+	set of weekday exchange holidays for the year
+	"""
+	if year in _holidays:
+		return _holidays[year]
+
+	days = set()
+
+	new_years = datetime.date(year, 1, 1)
+	if new_years.weekday() != 5:
+		# a saturday new year's is not moved back into the prior year
+		days.add(observed(new_years))
+	if year >= 1998:
+		days.add(nth_weekday(year, 1, 0, 3))		# mlk
+	days.add(nth_weekday(year, 2, 0, 3))			# washington's birthday
+	days.add(easter(year) - datetime.timedelta(days=2))	# good friday
+	days.add(nth_weekday(year, 5, 0, -1))			# memorial day
+	if year >= 2022:
+		days.add(observed(datetime.date(year, 6, 19)))	# juneteenth
+	days.add(observed(datetime.date(year, 7, 4)))
+	days.add(nth_weekday(year, 9, 0, 1))			# labor day
+	days.add(nth_weekday(year, 11, 3, 4))			# thanksgiving
+	days.add(observed(datetime.date(year, 12, 25)))
+
+	days |= set([d for d in closures if d.year == year])
+
+	_holidays[year] = days
+	return days
+
+
+def is_session (day):
+	return day.weekday() < 5 and day not in holidays(day.year)
+
+
+def previous_session (day):
+	"""
+	last session strictly before day
+	"""
+	day -= datetime.timedelta(days=1)
+	while not is_session(day):
+		day -= datetime.timedelta(days=1)
+	return day
+
+
+def has_session (first, last):
+	"""
+	true if there is any session between first and last (dates, inclusive)
+	"""
+	day = first
+	while day <= last:
+		if is_session(day):
+			return True
+		day += datetime.timedelta(days=1)
+	return False
+
+
+def eastern (utc=None):
+	"""
+	converts a naive utc datetime (default: now) to naive US/Eastern wall clock time
+	dst runs from 2am on the second sunday of march to 2am on the first sunday of november
+	"""
+	if utc is None:
+		utc = datetime.datetime.utcnow()
+
+	year = utc.year
+	dst_start = datetime.datetime.combine(nth_weekday(year, 3, 6, 2), datetime.time(7))
+	dst_end = datetime.datetime.combine(nth_weekday(year, 11, 6, 1), datetime.time(6))
+
+	if dst_start <= utc < dst_end:
+		return utc - datetime.timedelta(hours=4)
+	return utc - datetime.timedelta(hours=5)
+
+
+def last_session (utc=None):
+	"""
+	the most recent session whose daily bar should be available as of utc (default: now)
+	"""
+	now = eastern(utc)
+	today = now.date()
+	if is_session(today) and now >= datetime.datetime.combine(today, session_close) + publish_delay:
+		return today
+	return previous_session(today)
+
+
+if __name__ == "__main__":
+	import doctest
+	doctest.testmod()
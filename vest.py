@@ -36,9 +36,11 @@ from matplotlib.dates import DateFormatter, WeekdayLocator, HourLocator, DayLoca
 import urllib2	# for HTTPError
 from matplotlib.finance import candlestick
 import ystockquote
+import quotecache
+import fetcher
 
 from account import account, next_buy_at, next_sell_at
-from mdcache import mdcache, cachedir, DataError
+from mdcache import mdcache, cachedir, DataError, prefetch, forget
 from rsi import rsi
 from sto import sto
 import commission
@@ -292,7 +294,7 @@ class vest (object):
 			return
 
 		try:
-			data = ystockquote.get_all(self.symbol)
+			data = quotecache.get_all(self.symbol)
 		except IndexError:
 			# something raising this in ystockquote for data from some index symbols, e.g. ^DJI
 			# setting to an empty dict makes it blank out the detail pane
@@ -304,8 +306,9 @@ class vest (object):
 		self.quote_detail = data
 		model = gtk.ListStore(str, str)
 		self.tv_q_detail.set_model(model)
-		for k,v in data.iteritems():
-			model.append([k,v])
+		for k in ystockquote.FIELDS:
+			if k in data:
+				model.append([k, 'N/A' if data[k] is None else str(data[k])])
 
 		self.load_dca()
 	
@@ -335,15 +338,16 @@ class vest (object):
 			return
 
 		quotes = md.get_data()
+		cols = md.get_columns()
 
-		datevals = [ q[0] for q in quotes ]
-		closes   = [ q[2] for q in quotes ]
-		spot = closes[-1]
+		datevals = cols['date'].tolist()
+		closes   = cols['close'].tolist()
+		spot = quotes[-1][2]
 
 		todaynum = dates.date2num(today)
-		if (todaynum <= datevals[-1] + 5) and ('price' in self.quote_detail):
+		if (todaynum <= datevals[-1] + 5) and (self.quote_detail.get('price') is not None):
 			# today's data not in yet, use detail price for spot
-			spot = D(self.quote_detail['price'])
+			spot = self.quote_detail['price']
 			datevals += [ todaynum ]
 		
 		f = plt.figure()
@@ -355,8 +359,8 @@ class vest (object):
 		# rsi vs. sto
 		if False:
 			# rsi
-			if (todaynum <= datevals[-1] + 5) and ('price' in self.quote_detail):
-				closes   += [ spot ]
+			if (todaynum <= datevals[-1] + 5) and (self.quote_detail.get('price') is not None):
+				closes   += [ float(spot) ]
 				a.plot_date(todaynum, spot)
 
 			rsivals = rsi(closes, n=int(self.spin_q_rsi.get_value()))
@@ -370,7 +374,7 @@ class vest (object):
 			atop.set_yticks([30,70])
 		else:
 			# sto
-			if (todaynum <= datevals[-1] + 5) and ('price' in self.quote_detail):
+			if (todaynum <= datevals[-1] + 5) and (self.quote_detail.get('price') is not None):
 				quotes += [(todaynum, spot, spot, spot, spot, 0)]
 				a.plot_date(todaynum, spot)
 			stovals = sto(quotes, period=int(self.spin_q_rsi.get_value()))
@@ -490,7 +494,7 @@ class vest (object):
 		try:
 			graph = pnf.Graph(self.acct.name)
 			buf = graph.get_output(style='pango')
-		except IndexError:
+		except (IndexError, DataError):
 			return
 		self.text_pnf.modify_font(pango.FontDescription('Courier 9'))
 		self.text_pnf.set_buffer(buf)
@@ -578,14 +582,18 @@ class vest (object):
 				# skip cash xacts / splits
 				idx -= 1
 				ax = a.xacts[idx]
-			p = pnf.Graph(sym)
+			p = pnfs[sym]
 			alloc_data = a.compute_alloc(as_dict=True)
 			message = ''
 			if buy:
 				buysell = 'buy'
-				if p.columns[-1].marker == 'O':
+				if p.error:
+					print("Error getting pnf status for %s: %s" % (sym, p.error))
+					pnftxt = 'N/A'
+					pnfcolor = 'orange'
+				elif p.marker == 'O':
 					# O col
-					if d_spot > p.get_reversal():
+					if d_spot > p.reversal:
 						# imminent reversal?
 						message += 'PnF: possible reversal imminent '
 						pnftxt = 'OK'
@@ -595,7 +603,7 @@ class vest (object):
 						pnfcolor = 'red'
 				else:
 					# X col
-					if d_spot < p.get_reversal():
+					if d_spot < p.reversal:
 						message += 'PnF: possible reversal imminent '
 						pnftxt = 'WAIT'
 						pnfcolor = 'orange'
@@ -619,9 +627,13 @@ class vest (object):
 						message += '$$$: buy %d extra shares ' % alloc_buy
 			else:
 				buysell = 'sell'
-				if p.columns[-1].marker == 'X':
+				if p.error:
+					print("Error getting pnf status for %s: %s" % (sym, p.error))
+					pnftxt = 'N/A'
+					pnfcolor = 'orange'
+				elif p.marker == 'X':
 					# X col
-					if d_spot < p.get_reversal():
+					if d_spot < p.reversal:
 						message += 'PnF: possible reversal imminent '
 						pnftxt = 'OK'
 						pnfcolor = 'orange'
@@ -630,7 +642,7 @@ class vest (object):
 						pnfcolor = 'red'
 				else:
 					# O col
-					if d_spot > p.get_reversal():
+					if d_spot > p.reversal:
 						message += 'PnF: possible reversal imminent '
 						pnftxt = 'WAIT'
 						pnfcolor = 'orange'
@@ -670,16 +682,34 @@ class vest (object):
 
 		active_equities = sorted([a for a in b.eq if b.eq[a].xacts and b.eq[a].xacts[-1].position_qty > 0])
 
-		current_spot = {}
+		# network fetches for the whole cycle share one deadline, so a slow feed can't stall the alerts
+		deadline = fetcher.deadline()
+
+		# refresh histories for everything the pnf / sto checks below will look at in one go
+		# each is then loaded once for the whole cycle
+		forget()
+		prefetch(sorted(b.eq), deadline=deadline)
+
+		# spots for the whole book in a few batched requests, warming the shared quote cache
+		# get_spot() then answers from it (and covers any stragglers)
+		quotecache.get_prices(sorted(b.eq), deadline=deadline)
 		def get_spot (sym):
-			# spot memoizer
-			if sym not in current_spot:
-				try:
-					current_spot[sym] = D(ystockquote.get_price(sym))
-				except InvalidOperation:
-					# yahoo likes to return an html error when it can't connect
-					raise
-			return current_spot[sym]
+			# yahoo likes to return an html error when it can't connect, raising InvalidOperation
+			return D(quotecache.get_price(sym, deadline=deadline))
+
+		# pnf graphs for everything checked below, each brought up to date once, in parallel
+		if autoalert:
+			# no pnf table
+			pnf_syms = active_equities
+		else:
+			pnf_syms = sorted(b.eq)
+		spots = {}
+		for sym in pnf_syms:
+			try:
+				spots[sym] = get_spot(sym)
+			except (IOError, InvalidOperation):
+				print("Error getting spot for %s, skipping pnf reversal check" % sym)
+		pnfs = pnf.scan(pnf_syms, spots, deadline=deadline)
 
 		# foundational pgens
 		print("Checking foundational buy and sell points")
@@ -724,13 +754,12 @@ class vest (object):
 		# weakness (stochastic)
 		print("Checking stochastics")
 		alerts = []
-		strong_stos = sto_limits(symbols=active_equities)['strong']
-		for (sym, sto) in strong_stos:
+		stos = sto_limits(symbols=active_equities, deadline=deadline)
+		for (sym, sto) in stos['strong']:
 			alerts += [(sym, 'Strong')]
 
 		alerts += [('', '')]
-		weak_stos = sto_limits(symbols=active_equities)['weak']
-		for (sym, sto) in weak_stos:
+		for (sym, sto) in stos['weak']:
 			alerts += [(sym, 'Weak')]
 
 		print
@@ -763,15 +792,10 @@ class vest (object):
 			data = gtk.ListStore(str, str, str, str, str, str)
 			self.tvalerts3.set_model(data)
 			for acct in sorted(b.eq):
-				try:
-					spot = get_spot(acct)
-				except InvalidOperation:
-					print("Error getting spot for %s, skipping pnf" % acct)
-
-				try:
-					data.append(pnf.Graph(acct).status(current_spot=spot))
-				except IndexError:
-					print("Error getting pnf status, invalid data for %s" % acct)
+				if pnfs[acct].error:
+					print("Error getting pnf status, invalid data for %s: %s" % (acct, pnfs[acct].error))
+					continue
+				data.append(pnfs[acct].status)
 
 			# update timestamp
 			self.label_alert_update.set_text('Last Update: %s' % datetime.datetime.now())
@@ -969,6 +993,9 @@ def run_backtest ():
 #	fixed_value_map['tap'] = 0.0
 	fixed_value_map['sh'] = 4*default_fixed_value
 
+	# same default start as backtest()
+	prefetch(sorted(b.eq), date_from=datetime.date(year=2000, month=1, day=1))
+
 	for sym in sorted(b.eq):
 		fixed_value = default_fixed_value
 		if sym in fixed_value_map:
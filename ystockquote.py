@@ -10,8 +10,15 @@
 #  version 2.1 of the License, or (at your option) any later version.
 
 
-import urllib
-from time import sleep
+import csv, datetime
+from array import array
+import numpy as np
+import matplotlib.dates as dates
+import mdstore
+import provider
+import httppool
+import fetcher
+from collections import OrderedDict
 from decimal import *
 
 D = Decimal
@@ -29,73 +36,171 @@ sample usage:
 """
 
 
-def __request(symbol, stat):
-	url = 'http://finance.yahoo.com/d/quotes.csv?s=%s&f=%s' % (symbol, stat)
-	for _ in range(10):
-		try:
-			res = urllib.urlopen(url).read().strip().strip('"')
-			if _:
-				print("Succeeded on retry")
-			return res
-		except Exception, e:
-			print("Exception while retreiving %s: %s" % (symbol, e.__class__))
-	print("retry limit exceeded")
-	raise e
+class BadQuote(ValueError):
+	"""
+	intermittent bogus data from the yahoo api, worth retrying
+	"""
+	pass
+
+
+def __request(symbol, stat, deadline=None):
+	# goes through the active market data provider (yahoo unless replaying)
+	return fetcher.retry(lambda: provider.get().quote(symbol, stat), deadline=deadline)
+
+def _text(value):
+	value = value.strip().strip('"')
+	if value in ('', 'N/A'):
+		return None
+	return value
+
+
+def _decimal(value):
+	try:
+		return D(value.strip().strip('"'))
+	except InvalidOperation:
+		# N/A
+		return None
+
+
+def _int(value):
+	try:
+		return int(value.strip().strip('"'))
+	except ValueError:
+		return None
+
+
+def _scaled(value):
+	# e.g. market cap as 12.34B
+	value = value.strip().strip('"')
+	scale = {'K': 3, 'M': 6, 'B': 9, 'T': 12}.get(value[-1:])
+	if scale is None:
+		return _decimal(value)
+	try:
+		return D(value[:-1]) * 10 ** scale
+	except InvalidOperation:
+		return None
+
+
+# quote field name -> (quotes.csv stat code, parser)
+# parsers turn the raw value into a Decimal / int / str, None for N/A
+FIELDS = OrderedDict([
+		('price', ('l1', _decimal)),
+		('change', ('c1', _decimal)),
+		('volume', ('v', _int)),
+		('avg_daily_volume', ('a2', _int)),
+		('stock_exchange', ('x', _text)),
+		('market_cap', ('j1', _scaled)),
+		('book_value', ('b4', _decimal)),
+		('ebitda', ('j4', _scaled)),
+		('dividend_per_share', ('d', _decimal)),
+		('dividend_yield', ('y', _decimal)),
+		('earnings_per_share', ('e', _decimal)),
+		('52_week_high', ('k', _decimal)),
+		('52_week_low', ('j', _decimal)),
+		('50day_moving_avg', ('m3', _decimal)),
+		('200day_moving_avg', ('m4', _decimal)),
+		('price_earnings_ratio', ('r', _decimal)),
+		('price_earnings_growth_ratio', ('r5', _decimal)),
+		('price_sales_ratio', ('p5', _decimal)),
+		('price_book_ratio', ('p6', _decimal)),
+		('short_ratio', ('s7', _decimal)),
+	])
+
+
+def _parse(symbol, line, fields, deadline):
+	"""
+	typed dict of fields from one quotes.csv line
+	"""
+	values = csv.reader([line]).next()
+	if len(values) != len(fields):
+		# something yahoo does for data from some index symbols, e.g. ^DJI
+		raise IndexError("expected %d quote fields for %s, got %d" % (len(fields), symbol, len(values)))
+
+	data = {}
+	for (name, value) in zip(fields, values):
+		data[name] = FIELDS[name][1](value)
 
-def get_all(symbol):
+	if data.get('price') is not None and data['price'] > 1000000:
+		# intermittent bogus data from the yahoo api, only the price is asked for again
+		data['price'] = get_price(symbol, deadline=deadline)
+	return data
+
+
+def get_fields(symbols, fields=None, deadline=None):
+	"""
+	Get the named FIELDS (default: all of them) for a ticker symbol, or a list of
+	them, asking yahoo for just those fields.
+
+	For a single symbol returns a dictionary of field -> typed value, raising on
+	failure.  For a list returns symbol -> that dictionary, a batch_size chunk
+	per request, the chunks fetched concurrently; symbols whose quote couldn't be
+	had (network trouble for their chunk, no answer by the deadline) are left out.
+	"""
+	if fields is None:
+		fields = FIELDS.keys()
+	for name in fields:
+		if name not in FIELDS:
+			raise ValueError("unknown quote field: %s" % name)
+	stat = ''.join([FIELDS[name][0] for name in fields])
+
+	if isinstance(symbols, basestring):
+		return _parse(symbols, __request(symbols, stat, deadline=deadline), fields, deadline)
+
+	res = {}
+	symbols = list(symbols)
+	chunks = dict([(i, symbols[i:i+batch_size]) for i in range(0, len(symbols), batch_size)])
+
+	def _quotes(chunk):
+		return lambda: provider.get().quotes(chunk, stat)
+
+	(lines, errors) = fetcher.run(dict([(i, _quotes(chunks[i])) for i in chunks]), deadline=deadline)
+	for i in sorted(errors):
+		print("Exception while retreiving %d quotes: %s" % (len(chunks[i]), errors[i]))
+
+	for i in sorted(lines):
+		for (symbol, line) in zip(chunks[i], lines[i]):
+			try:
+				res[symbol] = _parse(symbol, line, fields, deadline)
+			except (IOError, ValueError, IndexError, InvalidOperation), e:
+				print("Exception while parsing %s quote: %s" % (symbol, e))
+
+	return res
+
+
+def get_all(symbol, deadline=None):
 	"""
 	Get all available quote data for the given ticker symbol.
 	
-	Returns a dictionary.
-	"""
-	def _data():
-		values = __request(symbol, 'l1c1va2xj1b4j4dyekjm3m4rr5p5p6s7').split(',')
-		data = {}
-		data['price'] = values[0]
-		data['change'] = values[1]
-		data['volume'] = values[2]
-		data['avg_daily_volume'] = values[3]
-		data['stock_exchange'] = values[4]
-		data['market_cap'] = values[5]
-		data['book_value'] = values[6]
-		data['ebitda'] = values[7]
-		data['dividend_per_share'] = values[8]
-		data['dividend_yield'] = values[9]
-		data['earnings_per_share'] = values[10]
-		data['52_week_high'] = values[11]
-		data['52_week_low'] = values[12]
-		data['50day_moving_avg'] = values[13]
-		data['200day_moving_avg'] = values[14]
-		data['price_earnings_ratio'] = values[15]
-		data['price_earnings_growth_ratio'] = values[16]
-		data['price_sales_ratio'] = values[17]
-		data['price_book_ratio'] = values[18]
-		data['short_ratio'] = values[19]
-		return data
-
-	data = _data()
-	strikes = 5
-	while float(data['price']) > 1000000 and strikes > 0:
-		sleep(1)
-		# cope with intermittent bogus bullshit from the yahoo api
-		strikes -= 1
-		data = _data()
-	if float(data['price']) > 1000000:
-		raise ValueError("bad spot data from yahoo api: %s" % data['price'])
-	return data
+	Returns a dictionary of typed values, see FIELDS.
+	"""
+	return get_fields(symbol, deadline=deadline)
 	
 	
-def get_price(symbol): 
-	value = D(__request(symbol, 'l1'))
-	strikes = 5
-	while value > 1000000 and strikes > 0:
-		sleep(1)
-		# cope with intermittent bogus bullshit from the yahoo api
-		strikes -= 1
-		value = D(__request(symbol, 'l1'))
-	if value > 1000000:
-		raise ValueError("bad spot data from yahoo api: %s" % value)
-	return value
+def get_price(symbol, deadline=None): 
+	def _price():
+		value = D(provider.get().quote(symbol, 'l1'))
+		if value > 1000000:
+			# cope with intermittent bogus bullshit from the yahoo api
+			raise BadQuote("bad spot data from yahoo api: %s" % value)
+		return value
+
+	return fetcher.retry(_price, retry_on=(IOError, BadQuote), deadline=deadline)
+
+
+# symbols per quotes.csv request in get_fields() / get_prices()
+batch_size = 200
+
+
+def get_prices(symbols, deadline=None):
+	"""
+	Get the last price for many ticker symbols, see get_fields().
+
+	Returns a dictionary of symbol -> Decimal.  Symbols whose price couldn't be
+	had (bad symbol, network trouble for their chunk, no answer by the deadline)
+	are left out.
+	"""
+	quotes = get_fields(list(symbols), ['price'], deadline=deadline)
+	return dict([(s, quotes[s]['price']) for s in quotes if quotes[s]['price'] is not None])
 
 
 def get_change(symbol):
@@ -174,14 +279,9 @@ def get_short_ratio(symbol):
 	return __request(symbol, 's7')
 	
 	
-def get_historical_prices(symbol, start_date, end_date):
-	"""
-	Get historical prices for the given ticker symbol.
-	Date format is 'YYYYMMDD'
-	
-	Returns a nested list.
-	"""
-	url = 'http://ichart.yahoo.com/table.csv?s=%s&' % symbol + \
+def historical_url(symbol, start_date, end_date):
+	# dates as 'YYYYMMDD'
+	return 'http://ichart.yahoo.com/table.csv?s=%s&' % symbol + \
 		  'd=%s&' % str(int(end_date[4:6]) - 1) + \
 		  'e=%s&' % str(int(end_date[6:8])) + \
 		  'f=%s&' % str(int(end_date[0:4])) + \
@@ -190,7 +290,67 @@ def get_historical_prices(symbol, start_date, end_date):
 		  'b=%s&' % str(int(start_date[6:8])) + \
 		  'c=%s&' % str(int(start_date[0:4])) + \
 		  'ignore=.csv'
-	days = urllib.urlopen(url).readlines()
-	data = [day[:-2].split(',') for day in days]
+
+
+def get_historical_prices(symbol, start_date, end_date):
+	"""
+	Get historical prices for the given ticker symbol.
+	Date format is 'YYYYMMDD'
+	
+	Returns a nested list.
+	"""
+	data = [day[:-2].split(',') for day in httppool.request(historical_url(symbol, start_date, end_date))]
 	return data
 
+
+def parse_historical(lines, adjusted=True):
+	"""
+	Parse yahoo table.csv lines (Date,Open,High,Low,Close,Volume[,Adj Close]) as
+	they are read, from any iterable of lines.
+
+	Yields (datenum, open, close, high, low, volume) float tuples, the order of
+	quotes_historical_yahoo and mdcache, in the order of the input (yahoo sends
+	newest first).  With adjusted, prices are scaled by Adj Close / Close for
+	splits and dividends as quotes_historical_yahoo does.
+	"""
+	for rec in csv.reader(lines):
+		if len(rec) < 6 or rec[0] == 'Date':
+			# header, blank line
+			continue
+		# YYYY-MM-DD, split by hand: strptime's lazy first import isn't thread safe under python 2
+		d = dates.date2num(datetime.date(int(rec[0][:4]), int(rec[0][5:7]), int(rec[0][8:10])))
+		(o, h, l, c, v) = [float(x) for x in rec[1:6]]
+		if adjusted and len(rec) > 6 and rec[6] and c:
+			scale = float(rec[6]) / c
+			(o, h, l, c) = (o * scale, h * scale, l * scale, c * scale)
+		yield (d, o, c, h, l, v)
+
+
+def iter_historical_prices(symbol, start_date, end_date, adjusted=True):
+	"""
+	Stream historical prices for the given ticker symbol, see parse_historical().
+	Date format is 'YYYYMMDD'.  Rows come newest first.
+	"""
+	return parse_historical(httppool.request(historical_url(symbol, start_date, end_date)), adjusted)
+
+
+def get_historical_columns(symbol, start_date, end_date, adjusted=True):
+	"""
+	Historical prices for the given ticker symbol straight into column arrays.
+	Date format is 'YYYYMMDD'
+
+	Returns a dict of oldest first float64 arrays keyed by mdstore.columns, as
+	mdcache stores them.  Rows go from the stream into flat typed buffers, so
+	neither the response text nor a list of rows is held along the way.
+	"""
+	bufs = [array('d') for name in mdstore.columns]
+	for row in iter_historical_prices(symbol, start_date, end_date, adjusted):
+		for (buf, value) in zip(bufs, row):
+			buf.append(value)
+
+	if not len(bufs[0]):
+		return mdstore.to_columns([])
+
+	cols = [np.frombuffer(buf, dtype=np.float64) for buf in bufs]
+	order = cols[0].argsort(kind='mergesort')
+	return dict([(name, col[order].astype(mdstore.dtype)) for (name, col) in zip(mdstore.columns, cols)])